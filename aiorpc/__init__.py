@@ -1,4 +1,16 @@
+from aiorpc.capture import TrafficCapture
 from aiorpc.client import RPCClient
+from aiorpc.diagnostics import Diagnostics
+from aiorpc.fileregion import FileRegion
+from aiorpc.peer import Peer
+from aiorpc.policy import RetryPolicy, HedgePolicy, BatchPolicy
+from aiorpc.proxy import RPCProxy
+from aiorpc.router import RoutingClient, HashRing
+from aiorpc.scheduler import Lane, Scheduler
 from aiorpc.server import *
+from aiorpc.sync_client import SyncRPCClient
 
-__all__ = ['RPCClient', 'RPCServer', 'register', 'msgpack_init', 'set_timeout', 'serve', 'register_class']
+__all__ = ['RPCClient', 'SyncRPCClient', 'RPCServer', 'RPCProxy', 'Peer', 'Diagnostics', 'TrafficCapture', 'FileRegion',
+           'RetryPolicy', 'HedgePolicy', 'BatchPolicy',
+           'RoutingClient', 'HashRing', 'Lane', 'Scheduler', 'register', 'msgpack_init', 'set_timeout',
+           'set_limits', 'serve', 'register_class']
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import itertools
+import os
+import random
+import time
+
+import msgpack
+
+from aiorpc.log import rootLogger
+
+__all__ = ['TrafficCapture', 'read_capture']
+
+_logger = rootLogger.getChild(__name__)
+
+
+class TrafficCapture:
+    """Append-only capture of the raw request frames received by an RPCServer.
+    Usage:
+        >>> capture = TrafficCapture('requests.capture', sample_rate=0.01)
+        >>> rpc_server = RPCServer(capture=capture)
+
+    Every record is a msgpack array ``[timestamp, connection id, raw frame]``,
+    see read_capture. Sampling picks whole connections, so a sampled client
+    is captured with all its requests in order.
+
+    :param str path: Capture file, appended to.
+    :param float sample_rate: Share of the connections captured, 0 to 1.
+    :param int max_bytes: The capture stops once the file reaches that size.
+    """
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=100 * 1024 ** 2):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._file = None
+        self._size = 0
+        self._conn_ids = itertools.count(1)
+        self.records = 0
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+            self._size = os.path.getsize(self.path)
+        return self._file
+
+    def full(self):
+        return self._file is not None and self._size >= self.max_bytes
+
+    def sample_connection(self):
+        """Return the id to capture a new connection under, or None to skip it."""
+        if self.full() or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        return next(self._conn_ids)
+
+    def write(self, conn_id, raw):
+        """Append the raw frame `raw` received on connection `conn_id`."""
+        f = self._open()
+        if self._size >= self.max_bytes:
+            return
+        record = msgpack.packb((time.time(), conn_id, raw), use_bin_type=True)
+        f.write(record)
+        self._size += len(record)
+        self.records += 1
+        if self._size >= self.max_bytes:
+            _logger.warning("Capture %s reached %d bytes, stopping", self.path, self.max_bytes)
+            f.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_capture(path):
+    """Iterate over the ``(timestamp, connection id, raw frame)`` records of a capture."""
+    with open(path, 'rb') as f:
+        for timestamp, conn_id, raw in msgpack.Unpacker(f, raw=False, use_list=False):
+            yield timestamp, conn_id, raw
@@ -1,17 +1,45 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import copy
+import functools
 import logging
+import os
+import random
+import socket
+import time
 import msgpack
 
 from aiorpc.connection import Connection
+from aiorpc.fileregion import FileRegion, FD_CHANNEL_METHOD, FD_EXT_TYPE
+from aiorpc.interceptor import match_methods, compose
 from aiorpc.log import rootLogger
-from aiorpc.constants import MSGPACKRPC_RESPONSE, MSGPACKRPC_REQUEST
-from aiorpc.exceptions import RPCProtocolError, RPCError, EnhancedRPCError
+from aiorpc.constants import MSGPACKRPC_RESPONSE, MSGPACKRPC_REQUEST, MSGPACKRPC_NOTIFY, \
+    MAX_BUFFER_SIZE, MSGPACKRPC_MAX_MSGID, MIGRATE_METHOD
+from aiorpc.exceptions import RPCProtocolError, RPCError, EnhancedRPCError, ConnectionLostError, \
+    MethodNotFoundError, MethodRegisteredError
+from aiorpc.stub import Stub
+from aiorpc.timer import get_timer_wheel
+from aiorpc.tls import ResumingContext, get_session, remember_session
 
 __all__ = ['RPCClient']
 
 _logger = rootLogger.getChild(__name__)
 
+# fixarray of 4 and the type tag, the constant start of every request frame
+_REQUEST_HEADER = bytes((0x94, MSGPACKRPC_REQUEST))
+
+
+class _PendingCall:
+    """Entry of the pending call table, expired by the shared TimerWheel."""
+    __slots__ = ('future',)
+
+    def __init__(self, future):
+        self.future = future
+
+    def expire(self):
+        if not self.future.done():
+            self.future.set_exception(asyncio.TimeoutError())
+
 
 class RPCClient:
     """RPC client.
@@ -26,14 +54,47 @@ class RPCClient:
     :param str host: Hostname.
     :param int port: Port number.
     :param int path: Unix socket path. Either this one or host and port are required.
-    :param int timeout: (optional) Socket timeout.
+    :param int timeout: (optional) Timeout of every call and write, seconds.
+    :param loop: (optional) Deprecated, kept only for backward compatibility.
+        The running event loop is always used.
     :param dict pack_params: (optional) Parameters to pass to Messagepack Packer
     :param dict unpack_params: (optional) Parameters to pass to Messagepack
         Unpacker.
+    :param int max_buffer_size: (optional) Bytes of responses buffered at most.
+        Defaults to 100MiB.
+    :param int max_message_size: (optional) Largest encoded response accepted.
+    :param dict retry_policies: (optional) Method name to RetryPolicy. Only the
+        listed methods, which must be idempotent, are retried.
+    :param dict hedge_policies: (optional) Method name to HedgePolicy.
+    :param int connect_attempts: (optional) Connection attempts before giving up.
+    :param float reconnect_backoff: (optional) Delay before the second connection
+        attempt in seconds. Doubled on every following attempt.
+    :param float max_reconnect_backoff: (optional) Upper bound of the delay
+        between two connection attempts.
+    :param local: (optional) RPCServer of this process. Calls are dispatched
+        straight into it without sockets, host, port and path are ignored.
+    :param str local_copy: (optional) How arguments and results cross a local
+        call: 'none' passes the objects as they are, 'copy' deep copies them,
+        'msgpack' round-trips them through msgpack like the wire does.
+        Defaults to 'copy'.
+    :param interceptors: (optional) Interceptors applied to every method, see
+        add_interceptor.
+    :param bool receive_fds: (optional) On a unix socket, receive FileRegion
+        results as file descriptors passed with SCM_RIGHTS instead of their
+        content. Uses a second connection to the server.
+    :param ssl: (optional) ssl.SSLContext enabling TLS. Clients sharing the
+        context resume the TLS session of the last connection to the same
+        server, so reconnects and pools skip full handshakes.
+    :param str server_hostname: (optional) Name the server certificate is
+        checked against. Defaults to host.
     """
 
     def __init__(self, host=None, port=None, path=None, timeout=3, loop=None,
-                 pack_params=None, unpack_params=None):
+                 pack_params=None, unpack_params=None, max_buffer_size=None,
+                 max_message_size=None, retry_policies=None, hedge_policies=None,
+                 connect_attempts=3, reconnect_backoff=0.05, max_reconnect_backoff=2,
+                 local=None, local_copy='copy', interceptors=None, receive_fds=False,
+                 ssl=None, server_hostname=None):
         self._host = host
         self._port = port
         self._path = path
@@ -43,100 +104,340 @@ class RPCClient:
         self._conn = None
         self._msg_id = 0
         self._pack_params = pack_params or dict()
+        self._packer = None
         self._unpack_params = unpack_params or dict(use_list=False)
-        self._msg_id_response_future_dict = {}
-        self._running = False
+        self._max_buffer_size = max_buffer_size or MAX_BUFFER_SIZE
+        self._max_message_size = max_message_size
+        self._pending = {}
+        self._wheel = None
+        self._retry_policies = dict(retry_policies or {})
+        self._hedge_policies = dict(hedge_policies or {})
+        self._connect_attempts = connect_attempts
+        self._reconnect_backoff = reconnect_backoff
+        self._max_reconnect_backoff = max_reconnect_backoff
+        self._connect_lock = None
+        self._hedge_client = None
+        self._local = local
+        if local_copy not in ('none', 'copy', 'msgpack'):
+            raise ValueError("Unknown local_copy {}".format(local_copy))
+        self._local_copy = local_copy
+        self._interceptors = []
+        # method name -> interceptor chain, built on the first call of the method
+        self._chains = {}
+        for interceptor in interceptors or ():
+            self.add_interceptor(interceptor)
+        self._receive_fds = receive_fds
+        # functions the server may call over this connection
+        self._handlers = {}
+        self._ssl = ssl
+        self._server_hostname = server_hostname
+        self._metrics = dict(connections=0, tls_handshakes=0, tls_resumed=0,
+                             tls_handshake_ms=0.0, tls_handshake_ms_total=0.0)
+        self._fd_channel = None
+        # descriptors received ahead of their response, by sequence number
+        self._fds = {}
 
     def getpeername(self):
         """Return the address of the remote endpoint."""
+        if self._local is not None:
+            return ('local', id(self._local))
         return (self._host, self._port) if self._host else ('unix', self._path)
 
+    def get_metrics(self):
+        """Return a snapshot of the client counters.
+
+        :return: dict with connections (opened so far), tls_handshakes,
+            tls_resumed (handshakes resuming a session), tls_handshake_ms (last
+            one) and tls_handshake_ms_total. The handshake time is the time to
+            set the connection up, TCP connect included.
+        """
+        return dict(self._metrics)
+
     def close(self):
         try:
             self._conn.close()
         except AttributeError:
             pass
+        self._close_fd_channel()
+        if self._hedge_client is not None:
+            self._hedge_client.close()
+
+    def set_retry_policy(self, method, policy):
+        """Set the RetryPolicy of a method, None removes it."""
+        if policy is None:
+            self._retry_policies.pop(method, None)
+        else:
+            self._retry_policies[method] = policy
+
+    def set_hedge_policy(self, method, policy):
+        """Set the HedgePolicy of a method, None removes it."""
+        if policy is None:
+            self._hedge_policies.pop(method, None)
+        else:
+            self._hedge_policies[method] = policy
+
+    def register(self, name, f):
+        """Register a function the server can call over the connection of this
+        client, see the ``peer`` parameter of RPCServer.register.
+        Usage:
+            >>> client.register('invalidate', cache.pop)
+            >>> await client.call('subscribe', 'user:42')
+
+        :param name: The remote name of the function.
+        :param f: Function object. Must be a callable object or a coroutine function.
+        """
+        if not hasattr(f, "__call__"):
+            raise MethodRegisteredError("{} is not a callable object".format(f))
+        if name in self._handlers:
+            raise MethodRegisteredError("Name {} has already been used".format(name))
+        self._handlers[name] = f
+
+    def add_interceptor(self, interceptor, methods=None):
+        """Add an interceptor around the calls of this client.
+        Usage:
+            >>> async def add_token(method_name, args, proceed):
+            >>>     return await proceed(token, *args)
+            >>> client.add_interceptor(add_token)
+
+        Interceptors are coroutine functions getting the method name, the
+        argument tuple and `proceed`, calling the next interceptor or sending
+        the request. The chain of a method is composed once, on its first
+        call. The first interceptor added is the outermost one.
+
+        :param interceptor: Coroutine function ``(method_name, args, proceed)``.
+        :param methods: (optional) Method names, or a callable getting a method
+            name and returning a bool. Defaults to every method.
+        """
+        self._interceptors.append((interceptor, match_methods(methods)))
+        self._chains.clear()
+
+    def _tls_endpoint(self):
+        # a session is only resumed for the name its certificate was checked against
+        return self.getpeername(), self._server_hostname or self._host
 
     async def _open_connection(self):
         _logger.debug("connect to %s:%s...", *self.getpeername())
+        tls = dict()
+        if self._ssl is not None:
+            tls = dict(ssl=ResumingContext(self._ssl, get_session(self._ssl, self._tls_endpoint())),
+                       server_hostname=self._server_hostname or self._host)
+        start = time.monotonic()
         if self._host:
-            reader, writer = await asyncio.open_connection(self._host, self._port, loop=self._loop)
+            reader, writer = await asyncio.open_connection(self._host, self._port, **tls)
         else:
-            reader, writer = await asyncio.open_unix_connection(self._path, loop=self._loop)
+            reader, writer = await asyncio.open_unix_connection(self._path, **tls)
+        self._metrics['connections'] += 1
+        if tls:
+            duration = (time.monotonic() - start) * 1000
+            self._metrics['tls_handshakes'] += 1
+            self._metrics['tls_handshake_ms'] = duration
+            self._metrics['tls_handshake_ms_total'] += duration
+            if writer.get_extra_info('ssl_object').session_reused:
+                self._metrics['tls_resumed'] += 1
         self._conn = Connection(reader, writer,
                                 msgpack.Unpacker(raw=False,
-                                                 **self._unpack_params))
+                                                 max_buffer_size=self._max_buffer_size,
+                                                 **self._unpack_params),
+                                self._max_buffer_size, self._max_message_size)
+        asyncio.ensure_future(self._run(self._conn))
         _logger.debug("Connection to %s:%s established", *self.getpeername())
-
-    async def _get_responses_one_time(self):
-        responses = []
+        if self._receive_fds and not self._host:
+            self._close_fd_channel()
+            try:
+                await self._open_fd_channel()
+            except (EnhancedRPCError, RPCError) as e:
+                _logger.warning("Server at %s does not pass file descriptors: %s", self._path, e)
+
+    async def _open_fd_channel(self):
+        token = await self._wait_response(await self._call(FD_CHANNEL_METHOD))
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
         try:
-            _logger.debug('receiving result from server')
-            responses = await self._conn.recvall(self._timeout)
-            _logger.debug('receiving result completed')
-        except asyncio.TimeoutError as te:
-            _logger.error("Read request to %s:%s timeout", *self.getpeername())
-            self._conn.reader.set_exception(te)
-            raise te
+            await loop.sock_connect(sock, self._path)
+            await loop.sock_sendall(sock, msgpack.packb((MSGPACKRPC_REQUEST, 0, FD_CHANNEL_METHOD, (token,)),
+                                                        **self._pack_params))
+            unpacker = msgpack.Unpacker(raw=False, **self._unpack_params)
+            response = None
+            while response is None:
+                data = await asyncio.wait_for(loop.sock_recv(sock, 1024), self._timeout)
+                if not data:
+                    raise ConnectionLostError('Fd channel to {} closed'.format(self._path))
+                unpacker.feed(data)
+                response = next(unpacker, None)
+        except BaseException:
+            sock.close()
+            raise
+        _, _, error, _ = response
+        if error:
+            sock.close()
+            raise EnhancedRPCError(*error) if len(error) == 2 else RPCError(error)
+        self._fd_channel = sock
+
+    def _close_fd_channel(self):
+        if self._fd_channel is not None:
+            self._fd_channel.close()
+            self._fd_channel = None
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+    def _receive_file(self, data):
+        seq, offset, count = msgpack.unpackb(data)
+        fd = self._fds.pop(seq, None)
+        while fd is None:
+            # the server passes the descriptor before writing the response
+            msg, fds, _, _ = socket.recv_fds(self._fd_channel, 8, 1)
+            if not fds:
+                raise ConnectionLostError('Fd channel to {} closed'.format(self._path))
+            received = int.from_bytes(msg, 'big')
+            if received == seq:
+                fd = fds[0]
+            else:
+                self._fds[received] = fds[0]
+        return FileRegion(fd, offset, count)
+
+    async def _connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._conn is not None and not self._conn.is_closed():
+                return
+            delay = self._reconnect_backoff
+            for attempt in range(self._connect_attempts):
+                try:
+                    await self._open_connection()
+                    return
+                except OSError as e:
+                    if attempt + 1 >= self._connect_attempts:
+                        raise e
+                    _logger.warning("Connect to %s:%s failed: %s, retrying", *self.getpeername(), e)
+                    await asyncio.sleep(delay * random.uniform(0.5, 1))
+                    delay = min(delay * 2, self._max_reconnect_backoff)
+
+    async def _run(self, conn):
+        ssl_object = conn.writer.get_extra_info('ssl_object')
+        try:
+            while True:
+                _logger.debug('receiving result from server')
+                response = await conn.recv()
+                _logger.debug('receiving result completed')
+                if ssl_object is not None:
+                    # session tickets came along with the first response
+                    remember_session(self._ssl, self._tls_endpoint(), ssl_object)
+                    ssl_object = None
+
+                if not isinstance(response, tuple):
+                    logging.debug('Protocol error, received unexpected data: %r', response)
+                    raise RPCProtocolError('Invalid protocol')
+
+                if response and response[0] == MSGPACKRPC_REQUEST:
+                    asyncio.ensure_future(self._serve_request(conn, response))
+                    continue
+                if response and response[0] == MSGPACKRPC_NOTIFY:
+                    self._on_notification(conn, response)
+                    continue
+
+                self._parse_response(response)
+        except RPCProtocolError as e:
+            _logger.error("Dropping connection to %s:%s: %r", *self.getpeername(), e)
+            self._drop(conn, e)
         except Exception as e:
-            self._conn.reader.set_exception(e)
-            raise e
-
-        for response in responses:
-            if not isinstance(response, tuple):
-                logging.debug('Protocol error, received unexpected data: %r', response)
-                raise RPCProtocolError('Invalid protocol')
-
-            self._parse_response(response)
-
-    async def _run(self):
+            _logger.debug("Connection to %s:%s lost: %s", *self.getpeername(), e)
+            self._drop(conn, ConnectionLostError('Connection to {}:{} lost'.format(*self.getpeername())))
+
+    async def _serve_request(self, conn, request):
+        if len(request) != 4:
+            _logger.error("Invalid request from %s:%s: %r", *self.getpeername(), request)
+            return
+        _, msg_id, method, args = request
         try:
-            if not self._running:
-                self._running = True
-
-                while True:
-                    await self._get_responses_one_time()
-        finally:
-            self._running = False
-
-    def _run_once(self):
-        if not self._running:
-            asyncio.create_task(self._run())
-
-    async def _call(self, method, *args):
+            f = self._handlers.get(method)
+            if f is None:
+                raise MethodNotFoundError("No such method {}".format(method))
+            ret = f(*args)
+            if asyncio.iscoroutine(ret):
+                ret = await asyncio.wait_for(ret, self._timeout)
+            response = (MSGPACKRPC_RESPONSE, msg_id, None, ret)
+        except Exception as e:
+            _logger.error("Caught Exception in `%s`. %s: %s", method, type(e).__name__, e)
+            response = (MSGPACKRPC_RESPONSE, msg_id, (type(e).__name__, str(e)), None)
+        try:
+            await conn.sendall(msgpack.packb(response, **self._pack_params), self._timeout)
+        except Exception as e:
+            _logger.error("Exception %s raised when answering `%s` to %s:%s",
+                          e, method, *self.getpeername())
+
+    def _on_notification(self, conn, notification):
+        if len(notification) != 3 or notification[1] != MIGRATE_METHOD:
+            _logger.warning("Ignoring notification from %s:%s: %r", *self.getpeername(), notification)
+            return
+        params = notification[2]
+        target = params[0] if params else None
+        _logger.info("Server at %s:%s is draining, migrating to %s", *self.getpeername(), target)
+        if isinstance(target, str):
+            self._host, self._port, self._path = None, None, target
+        elif target:
+            self._host, self._port = target
+        # the following calls open a new connection, the calls in progress
+        # complete on this one until the server closes it
+        if self._conn is conn:
+            self._conn = None
+
+    def _drop(self, conn, exc):
+        if not conn.is_closed():
+            conn.close()
+        # a newer connection owns the pending calls once this one got replaced
+        if self._conn is conn:
+            self._fail_pending(exc)
+
+    def _fail_pending(self, exc):
+        for entry in self._pending.values():
+            if not entry.future.done():
+                entry.future.set_exception(exc)
+
+    async def _call(self, method, *args, _encoded=None):
         """Calls a RPC method without waiting for the response.
 
         :param str method: Method name.
         :param args: Method arguments.
+        :param bytes _encoded: (optional) Method name already encoded, see stub.
         """
 
         if self._conn is None or self._conn.is_closed():
-            await self._open_connection()
-
-        self._run_once()
+            await self._connect()
 
         _logger.debug('creating request')
-        req, msg_id = self._create_request(method, args)
+        req, msg_id = self._create_request(method, args, _encoded)
+
+        # registered before the write, the response may arrive at any time after it
+        loop = asyncio.get_running_loop()
+        entry = _PendingCall(loop.create_future())
+        self._pending[msg_id] = entry
+        if self._timeout:
+            if self._wheel is None or self._wheel._loop is not loop:
+                self._wheel = get_timer_wheel(loop)
+            self._wheel.schedule(self._timeout, entry)
 
         try:
             _logger.debug('Sending req: %s', req)
             await self._conn.sendall(req, self._timeout)
             _logger.debug('Sending complete')
         except asyncio.TimeoutError as te:
+            self._pending.pop(msg_id, None)
             _logger.error("Write request to %s:%s timeout", *self.getpeername())
             raise te
         except Exception as e:
+            self._pending.pop(msg_id, None)
             raise e
 
-        self._msg_id_response_future_dict[msg_id] = asyncio.get_running_loop().create_future()
-
         return msg_id
 
     async def _wait_response(self, msg_id, close=False):
         try:
-            result = await self._msg_id_response_future_dict[msg_id]
+            result = await self._pending[msg_id].future
         finally:
-            self._msg_id_response_future_dict.pop(msg_id)
+            self._pending.pop(msg_id, None)
             if close:
                 self.close()
         return result
@@ -148,13 +449,139 @@ class RPCClient:
     async def call(self, method, *args, _close=False):
         """Calls a RPC method.
 
+        Methods with a RetryPolicy are retried on transport failures, methods
+        with a HedgePolicy are hedged over a second connection.
+
         :param str method: Method name.
         :param args: Method arguments.
         :param _close: Close the connection at the end of the request. Defaults to false
         """
+        if self._interceptors:
+            chain = self._chains.get(method)
+            if chain is None:
+                chain = compose(method, functools.partial(self._send, method), self._interceptors)
+                # methods left alone by the interceptors are cached as False
+                self._chains[method] = chain or False
+            if chain:
+                try:
+                    return await chain(*args)
+                finally:
+                    if _close:
+                        self.close()
+        return await self._send(method, *args, _close=_close)
+
+    def stub(self, cls, name=None):
+        """Build a proxy calling the methods of a class registered on the server.
+        Usage:
+            >>> calculator = client.stub(Calculator)
+            >>> await calculator.add(1, 2)
+
+        Method names are encoded once, and the arguments of every call are
+        checked against the signatures of `cls` before anything is sent.
+
+        :param cls: Class registered on the server with register_class.
+        :param str name: (optional) Name the class is registered under.
+            Defaults to the class name.
+        """
+        return Stub(self, cls, name)
+
+    async def _call_stub(self, method, encoded, args):
+        if (self._interceptors or self._local is not None
+                or method in self._retry_policies or method in self._hedge_policies):
+            return await self.call(method, *args)
+        msg_id = await self._call(method, *args, _encoded=encoded)
+        return await self._wait_response(msg_id)
+
+    async def _send(self, method, *args, _close=False):
+        if self._local is not None:
+            return await self._call_local(method, args)
+
+        if not self._retry_policies and not self._hedge_policies:
+            msg_id = await self._call(method, *args)
+            return await self._wait_response(msg_id, _close)
 
+        try:
+            return await self._call_with_retry(method, args)
+        finally:
+            if _close:
+                self.close()
+
+    async def _call_local(self, method, args):
+        if self._local_copy == 'copy':
+            args = copy.deepcopy(args)
+        elif self._local_copy == 'msgpack':
+            args = self._roundtrip(args)
+        result = await self._local.call_local(method, args)
+        if self._local_copy == 'copy':
+            return copy.deepcopy(result)
+        elif self._local_copy == 'msgpack':
+            return self._roundtrip(result)
+        return result
+
+    def _roundtrip(self, obj):
+        return msgpack.unpackb(msgpack.packb(obj, **self._pack_params), raw=False, **self._unpack_params)
+
+    async def _call_with_retry(self, method, args):
+        retry = self._retry_policies.get(method)
+        attempt = 0
+        while True:
+            try:
+                return await self._call_with_hedge(method, args)
+            except Exception as e:
+                if retry is None or not retry.should_retry(e, attempt):
+                    raise e
+                delay = retry.delay(attempt)
+                _logger.warning("Call `%s` failed: %r, retrying in %fs", method, e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _call_with_hedge(self, method, args):
+        hedge = self._hedge_policies.get(method)
+        if hedge is None:
+            msg_id = await self._call(method, *args)
+            return await self._wait_response(msg_id)
+
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        primary = asyncio.ensure_future(self._call_with_hedge_disabled(method, args))
+        delay = hedge.threshold()
+        tasks = [primary]
+        if delay is not None:
+            await asyncio.wait(tasks, timeout=delay)
+            if not primary.done():
+                _logger.debug("Hedging call `%s` after %fs", method, delay)
+                tasks.append(asyncio.ensure_future(
+                    self._get_hedge_client()._call_with_hedge_disabled(method, args)))
+        try:
+            while True:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in done if t.exception() is None), None)
+                if winner is not None or not pending:
+                    break
+                tasks = list(pending)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if winner is None:
+            # every attempt failed, report the primary failure
+            return primary.result()
+        hedge.observe(loop.time() - start)
+        return winner.result()
+
+    async def _call_with_hedge_disabled(self, method, args):
         msg_id = await self._call(method, *args)
-        return await self._wait_response(msg_id, _close)
+        return await self._wait_response(msg_id)
+
+    def _get_hedge_client(self):
+        if self._hedge_client is None:
+            self._hedge_client = RPCClient(
+                self._host, self._port, self._path, self._timeout,
+                pack_params=self._pack_params, unpack_params=self._unpack_params,
+                max_buffer_size=self._max_buffer_size, max_message_size=self._max_message_size,
+                connect_attempts=self._connect_attempts, reconnect_backoff=self._reconnect_backoff,
+                max_reconnect_backoff=self._max_reconnect_backoff,
+                ssl=self._ssl, server_hostname=self._server_hostname)
+        return self._hedge_client
 
     async def call_once(self, method, *args):
         """Call an RPC Method, then close the connection
@@ -165,12 +592,33 @@ class RPCClient:
         """
         return await self.call(method, *args, _close=True)
 
-    def _create_request(self, method, args):
-        self._msg_id += 1
+    def _next_msg_id(self):
+        # msgid is a 32 bit unsigned int, wrap around skipping ids still in use
+        msg_id = self._msg_id
+        while True:
+            msg_id = msg_id + 1 if msg_id < MSGPACKRPC_MAX_MSGID else 0
+            if msg_id not in self._pending:
+                self._msg_id = msg_id
+                return msg_id
+
+    def _get_packer(self):
+        if self._packer is None:
+            self._packer = msgpack.Packer(**self._pack_params)
+        return self._packer
+
+    def _encode_method(self, method):
+        return self._get_packer().pack(method)
+
+    def _create_request(self, method, args, encoded=None):
+        msg_id = self._next_msg_id()
+
+        if encoded is not None:
+            packer = self._get_packer()
+            return b''.join((_REQUEST_HEADER, packer.pack(msg_id), encoded, packer.pack(args))), msg_id
 
-        req = (MSGPACKRPC_REQUEST, self._msg_id, method, args)
+        req = (MSGPACKRPC_REQUEST, msg_id, method, args)
 
-        return msgpack.packb(req, **self._pack_params), self._msg_id
+        return msgpack.packb(req, **self._pack_params), msg_id
 
     def _parse_response(self, response):
         if (len(response) != 4 or response[0] != MSGPACKRPC_RESPONSE):
@@ -178,7 +626,23 @@ class RPCClient:
 
         (_, msg_id, error, result) = response
 
-        future = self._msg_id_response_future_dict[msg_id]
+        if msg_id is None:
+            # the server rejected the connection as a whole, e.g. a limit was hit
+            self._fail_pending(EnhancedRPCError(*error) if error and len(error) == 2
+                               else RPCError(error))
+            return
+
+        if type(result) is msgpack.ExtType and result.code == FD_EXT_TYPE and self._fd_channel is not None:
+            # taken off the fd channel even for a call given up, keeps the channel in step
+            result = self._receive_file(result.data)
+
+        entry = self._pending.get(msg_id)
+        if entry is None or entry.future.done():
+            # the call was given up, e.g. it timed out or a hedged duplicate lost the race
+            if isinstance(result, FileRegion):
+                result.close()
+            return
+        future = entry.future
         if error and len(error) == 2:
             future.set_exception(EnhancedRPCError(*error))
         elif error:
@@ -187,7 +651,8 @@ class RPCClient:
             future.set_result(result)
 
     async def __aenter__(self):
-        await self._open_connection()
+        if self._local is None:
+            await self._connect()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
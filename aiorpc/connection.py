@@ -1,52 +1,176 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import time
+import msgpack
+
 from aiorpc.log import rootLogger
 from aiorpc.constants import SOCKET_RECV_SIZE
+from aiorpc.exceptions import RPCProtocolError, MessageTooLargeError
 
 __all__ = ['Connection']
 _logger = rootLogger.getChild(__name__)
 
 
 class Connection:
-    def __init__(self, reader, writer, unpacker):
+    """A msgpack stream over an asyncio reader/writer pair.
+
+    :param reader: asyncio.StreamReader.
+    :param writer: asyncio.StreamWriter.
+    :param unpacker: msgpack.Unpacker.
+    :param int max_buffer_size: (optional) Bytes buffered for this connection
+        at most. Should match the ``max_buffer_size`` of the unpacker.
+    :param int max_message_size: (optional) Largest single encoded message
+        accepted.
+    """
+
+    def __init__(self, reader, writer, unpacker, max_buffer_size=None, max_message_size=None):
         self.reader = reader
         self.writer = writer
         self.unpacker = unpacker
+        self.max_buffer_size = max_buffer_size
+        self.max_message_size = max_message_size
+        self._fed = 0
+        self._msg_start = 0
         self._is_closed = False
         self.peer = self.writer.get_extra_info('peername')
+        # bookkeeping of the owner, e.g. for idle connection sweeping
+        self.last_activity = time.monotonic()
+        self.pending = 0
+        # raw bytes of the undecoded messages, only kept while capturing
+        self._raw = None
+        self.last_raw = None
+        # created by the first sendfile, writes wait while a file is streamed
+        self._sendfile_lock = None
+        # server side _FdChannel of unix socket clients receiving file descriptors
+        self.fd_channel = None
+        # server side Peer handle, created once a function calls the client back
+        self.remote = None
+
+    def keep_raw(self):
+        """Keep the encoded bytes of every received message in `last_raw`."""
+        if self._raw is None:
+            self._raw = bytearray()
 
     async def sendall(self, raw_req, timeout):
+        if self._sendfile_lock is not None:
+            async with self._sendfile_lock:
+                return await self._sendall(raw_req, timeout)
+        return await self._sendall(raw_req, timeout)
+
+    async def _sendall(self, raw_req, timeout):
         _logger.debug('sending raw_req %s to %s', raw_req, self.peer)
+        if self.writer.transport.is_closing():
+            raise ConnectionResetError('Connection to {} closed'.format(self.peer))
         self.writer.write(raw_req)
-        await asyncio.wait_for(self.writer.drain(), timeout)
+        # most writes go straight to the socket, only wait when data got buffered
+        if self.writer.transport.get_write_buffer_size():
+            await asyncio.wait_for(self.writer.drain(), timeout)
+        self.last_activity = time.monotonic()
         _logger.debug('sending %s completed', raw_req)
 
-    async def recvall(self, timeout):
-        _logger.debug('entered recvall from %s', self.peer)
-        # buffer, line = bytearray(), b''
-        # while not line.endswith(b'\r\n'):
-        #     _logger.debug('receiving data, timeout: {}'.format(timeout))
-        #     line = await asyncio.wait_for(self.reader.readline(), timeout)
-        #     if not line:
-        #         break
-        #     _logger.debug('received data {}'.format(line))
-        #     buffer.extend(line)
-        # _logger.debug('buffer: {}'.format(buffer))
-        reqs = []
+    async def sendfile(self, header, file, offset, count):
+        """Send `header` followed by `count` bytes of `file` from `offset`,
+        with loop.sendfile. The content goes from the file to the socket
+        without being read into memory when the platform allows it.
+
+        The connection is closed when the file could not be sent completely,
+        since the peer got a truncated message.
+        """
+        if self._sendfile_lock is None:
+            self._sendfile_lock = asyncio.Lock()
+        async with self._sendfile_lock:
+            if self.writer.transport.is_closing():
+                raise ConnectionResetError('Connection to {} closed'.format(self.peer))
+            self.writer.write(header)
+            try:
+                await asyncio.get_event_loop().sendfile(self.writer.transport, file, offset, count)
+            except BaseException:
+                self.close()
+                raise
+            self.last_activity = time.monotonic()
+
+    def buffered(self):
+        """Return the number of received bytes not yet decoded into a message."""
+        return self._fed - self._msg_start
+
+    def _next_message(self, skip=False):
+        try:
+            msg = self.unpacker.skip() if skip else self.unpacker.unpack()
+        except msgpack.OutOfData:
+            if self.max_message_size is not None and self.buffered() > self.max_message_size:
+                raise MessageTooLargeError(
+                    'Message from {} exceeds {} bytes'.format(self.peer, self.max_message_size))
+            raise
+        except (msgpack.FormatError, msgpack.StackError) as e:
+            raise RPCProtocolError('Invalid message from {}: {}'.format(self.peer, e))
+        except ValueError as e:
+            # raised when a str/bin/array/map header exceeds the unpacker limits
+            raise MessageTooLargeError('Message from {} rejected: {}'.format(self.peer, e))
+        end = self.unpacker.tell()
+        size, self._msg_start = end - self._msg_start, end
+        if self._raw is not None:
+            self.last_raw = bytes(self._raw[:size])
+            del self._raw[:size]
+        if self.max_message_size is not None and size > self.max_message_size:
+            raise MessageTooLargeError(
+                'Message from {} exceeds {} bytes'.format(self.peer, self.max_message_size))
+        return self.last_raw if skip else msg
+
+    async def recv(self, timeout=None):
+        """Receive exactly one decoded message.
+
+        Already buffered messages are returned without touching the socket, so
+        callers handle requests one at a time instead of materializing every
+        message of a read.
+
+        :param timeout: (optional) Read timeout in seconds. Reads wait forever
+            when None, leaving idle detection to the owner of the connection.
+
+        :raises MessageTooLargeError: when a limit of this connection is hit.
+        :raises IOError: when the peer closed the connection.
+        """
+        return await self._recv(timeout, False)
+
+    async def recv_frame(self, timeout=None):
+        """Receive the encoded bytes of exactly one message, without decoding it.
+
+        The unpacker only walks the message to find where it ends, no Python
+        object is built for its content. Same limits and errors as recv.
+        """
+        self.keep_raw()
+        return await self._recv(timeout, True)
+
+    async def _recv(self, timeout, skip):
         while True:
-            data = await asyncio.wait_for(self.reader.read(SOCKET_RECV_SIZE), timeout)
+            try:
+                return self._next_message(skip)
+            except msgpack.OutOfData:
+                pass
+
+            size = SOCKET_RECV_SIZE
+            if self.max_buffer_size:
+                room = self.max_buffer_size - self.buffered()
+                if room <= 0:
+                    raise MessageTooLargeError(
+                        'Buffer for {} exceeds {} bytes'.format(self.peer, self.max_buffer_size))
+                size = min(size, room)
+            if timeout is None:
+                data = await self.reader.read(size)
+            else:
+                data = await asyncio.wait_for(self.reader.read(size), timeout)
             _logger.debug('receiving data %s from %s', data, self.peer)
             if not data:
                 raise IOError('Connection to {} closed'.format(self.peer))
-            self.unpacker.feed(data)
-            reqs = [*self.unpacker]
-            if len(reqs) == 0:
-                continue
-            break
-        _logger.debug('received reqs from %s : %s', self.peer, reqs)
-        _logger.debug('exiting recvall from %s', self.peer)
-        return reqs
+            try:
+                self.unpacker.feed(data)
+            except msgpack.BufferFull:
+                raise MessageTooLargeError(
+                    'Buffer for {} exceeds {} bytes'.format(self.peer, self.max_buffer_size))
+            self._fed += len(data)
+            self.last_activity = time.monotonic()
+            if self._raw is not None:
+                self._raw += data
 
     def close(self):
         self.reader.feed_eof()
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
 MSGPACKRPC_REQUEST = 0
 MSGPACKRPC_RESPONSE = 1
+MSGPACKRPC_NOTIFY = 2
 SOCKET_RECV_SIZE = 1024 ** 2
+MAX_BUFFER_SIZE = 100 * 1024 ** 2
+MSGPACKRPC_MAX_MSGID = 2 ** 32 - 1
+# control notification asking a client to move to a new connection
+MIGRATE_METHOD = '__migrate__'
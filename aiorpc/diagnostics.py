@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import deque
+
+from aiorpc.log import rootLogger
+from aiorpc.timer import get_timer_wheel
+
+__all__ = ['Diagnostics', 'DIAGNOSTICS_METHOD']
+
+_logger = rootLogger.getChild(__name__)
+
+DIAGNOSTICS_METHOD = '__diagnostics__'
+
+
+def _format_coroutine_stack(coro):
+    # Task.get_stack() stops at the outermost coroutine of a suspended task,
+    # follow the await chain down to the frame actually waiting
+    lines = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is not None:
+            lines.extend(traceback.format_stack(frame, limit=1))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return lines
+
+
+class _CallRecord:
+    __slots__ = ('method_name', 'start', 'task', 'coro', 'stack', 'profiler', 'done')
+
+    def __init__(self, method_name, start, task, profiler):
+        self.method_name = method_name
+        self.start = start
+        self.task = task
+        # the coroutine returned by the function, set by the server
+        self.coro = None
+        self.stack = None
+        self.profiler = profiler
+        self.done = False
+
+    def expire(self):
+        # still running at the threshold: the stack shows where it waits
+        if self.done:
+            return
+        if self.coro is not None:
+            self.stack = _format_coroutine_stack(self.coro)
+        elif self.task is not None:
+            self.stack = _format_coroutine_stack(self.task.get_coro())
+
+
+class _LoopWatchdog(threading.Thread):
+    """Pings the loop from a thread. The ping delay is the loop lag, and a ping
+    left unanswered past the threshold means the loop thread is blocked: its
+    stack is captured while it is still stuck."""
+
+    def __init__(self, diagnostics, loop, loop_thread_id):
+        super().__init__(name='aiorpc-loop-watchdog', daemon=True)
+        self._diagnostics = diagnostics
+        self._loop = loop
+        self._loop_thread_id = loop_thread_id
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        diagnostics = self._diagnostics
+        while not self._stopped.wait(diagnostics.lag_interval):
+            answered = threading.Event()
+            sent = time.monotonic()
+            try:
+                self._loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:
+                return  # the loop is closed
+            if not answered.wait(diagnostics.lag_threshold):
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = traceback.format_stack(frame) if frame is not None else []
+                while not answered.wait(diagnostics.lag_interval):
+                    if self._stopped.is_set():
+                        return
+                diagnostics._record(dict(kind='loop_blocked', method=None,
+                                         duration_ms=(time.monotonic() - sent) * 1000,
+                                         at=time.time(), stack=stack))
+            diagnostics._observe_lag(time.monotonic() - sent)
+
+
+class Diagnostics:
+    """Production diagnostics of an RPCServer.
+    Usage:
+        >>> rpc_server = RPCServer(diagnostics=Diagnostics(slow_call_threshold=0.2))
+        >>> await client.call('__diagnostics__')
+
+    - Loop lag: a watchdog thread pings the event loop every `lag_interval`
+      and tracks how late the pings run. A loop blocked for longer than
+      `lag_threshold` gets the stack of the loop thread recorded.
+    - Slow calls: a call still running after `slow_call_threshold` gets the
+      stack of its task recorded, the shared TimerWheel fires the check.
+    - With `profile`, a method that was slow gets its next call run under
+      cProfile, which profiles the loop thread while that call runs. With
+      tracemalloc tracing enabled, the top allocations are attached to every
+      record.
+
+    Records are kept in a ring buffer of `capacity` entries, returned by the
+    reserved `__diagnostics__` method.
+
+    :param float slow_call_threshold: Seconds after which a call is slow.
+    :param float lag_threshold: Seconds of loop lag after which the loop counts as blocked.
+    :param float lag_interval: Seconds between two loop pings.
+    :param int capacity: Records kept.
+    :param bool profile: Profile the call following a slow one of the same method.
+    :param int tracemalloc_top: Allocation sites attached when tracemalloc is tracing.
+    """
+
+    def __init__(self, slow_call_threshold=0.5, lag_threshold=0.1, lag_interval=0.5,
+                 capacity=128, profile=False, tracemalloc_top=10):
+        self.slow_call_threshold = slow_call_threshold
+        self.lag_threshold = lag_threshold
+        self.lag_interval = lag_interval
+        self.profile = profile
+        self.tracemalloc_top = tracemalloc_top
+        self._records = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._profile_next = set()
+        self._watchdog = None
+        self._lag = dict(last_ms=0.0, max_ms=0.0, samples=0, blocked=0)
+
+    def install(self, server):
+        """Hook into `server` and register the reserved method on it."""
+        server.register(DIAGNOSTICS_METHOD, self.report)
+
+    def start(self):
+        """Start the loop watchdog on the running loop, if not running yet."""
+        if self._watchdog is None:
+            self._watchdog = _LoopWatchdog(self, asyncio.get_event_loop(), threading.get_ident())
+            self._watchdog.start()
+
+    def stop(self):
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+
+    def begin(self, method_name):
+        """Called by the server before a call runs."""
+        profiler = None
+        if self._profile_next and method_name in self._profile_next:
+            self._profile_next.discard(method_name)
+            profiler = cProfile.Profile()
+            profiler.enable()
+        loop = asyncio.get_event_loop()
+        record = _CallRecord(method_name, loop.time(), asyncio.current_task(), profiler)
+        get_timer_wheel(loop).schedule(self.slow_call_threshold, record)
+        return record
+
+    def end(self, record):
+        """Called by the server once the call finished."""
+        record.done = True
+        duration = asyncio.get_event_loop().time() - record.start
+        profile = None
+        if record.profiler is not None:
+            record.profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(record.profiler, stream=out).sort_stats('cumulative').print_stats(20)
+            profile = out.getvalue()
+        if duration < self.slow_call_threshold and profile is None:
+            return
+        if self.profile and profile is None:
+            self._profile_next.add(record.method_name)
+        entry = dict(kind='call', method=record.method_name, duration_ms=duration * 1000,
+                     at=time.time(), stack=record.stack)
+        if profile is not None:
+            entry['profile'] = profile
+        _logger.warning("Slow call `%s` took %fms", record.method_name, duration * 1000)
+        self._record(entry)
+
+    def _record(self, entry):
+        if self.tracemalloc_top and tracemalloc.is_tracing():
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:self.tracemalloc_top]
+            entry['tracemalloc'] = [str(stat) for stat in stats]
+        with self._lock:
+            if entry['kind'] == 'loop_blocked':
+                self._lag['blocked'] += 1
+            self._records.append(entry)
+
+    def _observe_lag(self, lag):
+        with self._lock:
+            self._lag['last_ms'] = lag * 1000
+            self._lag['max_ms'] = max(self._lag['max_ms'], lag * 1000)
+            self._lag['samples'] += 1
+
+    def report(self, limit=None):
+        """Return the loop lag statistics and the recent records, newest last."""
+        with self._lock:
+            records = list(self._records)
+            lag = dict(self._lag)
+        if limit is not None:
+            records = records[-limit:]
+        return dict(loop_lag=lag, records=records)
@@ -5,6 +5,14 @@ class RPCProtocolError(Exception):
     pass
 
 
+class MessageTooLargeError(RPCProtocolError):
+    pass
+
+
+class ConnectionLostError(ConnectionError):
+    pass
+
+
 class MethodNotFoundError(Exception):
     pass
 
@@ -23,3 +31,7 @@ class EnhancedRPCError(Exception):
 
 class MethodRegisteredError(Exception):
     pass
+
+
+class LaneFullError(Exception):
+    pass
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+
+__all__ = ['FileRegion', 'FD_CHANNEL_METHOD', 'FD_EXT_TYPE']
+
+# reserved method linking the fd channel of a unix socket client, see RPCClient(receive_fds=True)
+FD_CHANNEL_METHOD = '__fd_channel__'
+# msgpack ext type of a result passed as file descriptor
+FD_EXT_TYPE = 1
+
+
+class FileRegion:
+    """Part of a file returned by a RPC function without being read into memory.
+    Usage:
+        >>> def get_artifact(name):
+        >>>     return FileRegion(os.path.join(ARTIFACTS, name))
+
+    The server writes a small msgpack header and streams the region with
+    loop.sendfile, clients receive the content as a bytes result. A client of
+    a unix socket created with ``receive_fds=True`` gets a FileRegion holding
+    a file descriptor passed with SCM_RIGHTS instead, to read or mmap:
+
+        >>> region = await client.call('get_artifact', 'weights.bin')
+        >>> data = mmap.mmap(region.fileno(), 0, access=mmap.ACCESS_READ)
+
+    The region owns the file: the server closes it once sent, a client closes
+    the received descriptor with close().
+
+    :param file: Path, binary file object or file descriptor.
+    :param int offset: (optional) Start of the region in the file.
+    :param int count: (optional) Length of the region. Defaults to the end of the file.
+    """
+
+    def __init__(self, file, offset=0, count=None):
+        self.offset = offset
+        self.count = count
+        self._file = file
+        self._f = None
+
+    def _is_path(self):
+        return isinstance(self._file, (str, bytes, os.PathLike))
+
+    def open(self):
+        """Return the file object of the region, opening it if needed."""
+        if self._f is None:
+            self._f = open(self._file, 'rb') if self._is_path() or isinstance(self._file, int) \
+                else self._file
+        return self._f
+
+    def fileno(self):
+        return self.open().fileno()
+
+    def size(self):
+        if self.count is not None:
+            return self.count
+        return max(0, os.fstat(self.fileno()).st_size - self.offset)
+
+    def read(self):
+        """Read the whole region into memory."""
+        f = self.open()
+        f.seek(self.offset)
+        return f.read(self.size())
+
+    def close(self):
+        if self._f is not None or not self._is_path():
+            self.open().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __deepcopy__(self, memo):
+        # local calls hand the region over as is, it can't be copied
+        return self
+
+
+class _FdChannel:
+    """Server end of the unix socket a client receives file descriptors on.
+    Every descriptor goes with a sequence number, repeated in the response."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._sock = socket.socket(fileno=os.dup(conn.writer.get_extra_info('socket').fileno()))
+        self._seq = 0
+
+    def send(self, fd):
+        self._seq += 1
+        socket.send_fds(self._sock, [self._seq.to_bytes(8, 'big')], [fd])
+        return self._seq
+
+    def close(self):
+        self._sock.close()
+        self._conn.close()
+
+
+def _is_unix_socket(conn):
+    sock = conn.writer.get_extra_info('socket')
+    return sock is not None and sock.family == socket.AF_UNIX
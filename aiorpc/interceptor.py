@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['match_methods', 'compose']
+
+
+def match_methods(methods=None):
+    """Build the predicate telling which methods an interceptor applies to.
+
+    :param methods: (optional) None for every method, a collection of method
+        names, or a callable getting the method name and returning a bool.
+    """
+    if methods is None:
+        return lambda method_name: True
+    if callable(methods):
+        return methods
+    return frozenset(methods).__contains__
+
+
+def _layer(interceptor, method_name, proceed):
+    async def layer(*args):
+        return await interceptor(method_name, args, proceed)
+    return layer
+
+
+def compose(method_name, call, interceptors):
+    """Fold the interceptors matching `method_name` around `call`.
+    The first interceptor is the outermost one. The chain is built once and
+    reused for every call of the method.
+
+    :param str method_name: Method name.
+    :param call: Coroutine function getting the method arguments.
+    :param interceptors: ``(interceptor, predicate)`` pairs, see match_methods.
+    :return: The chain, or None when no interceptor applies to the method.
+    """
+    matching = [interceptor for interceptor, match in interceptors if match(method_name)]
+    if not matching:
+        return None
+    for interceptor in reversed(matching):
+        call = _layer(interceptor, method_name, call)
+    return call
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import msgpack
+
+from aiorpc.constants import MSGPACKRPC_REQUEST, MSGPACKRPC_MAX_MSGID
+from aiorpc.exceptions import RPCError, EnhancedRPCError
+from aiorpc.log import rootLogger
+from aiorpc.timer import get_timer_wheel
+
+__all__ = ['Peer']
+
+_logger = rootLogger.getChild(__name__)
+
+
+class _PendingCall:
+    __slots__ = ('future',)
+
+    def __init__(self, future):
+        self.future = future
+
+    def expire(self):
+        if not self.future.done():
+            self.future.set_exception(asyncio.TimeoutError())
+
+
+class Peer:
+    """Handle calling the functions a client registered, over the connection
+    it opened to the server. Given to the functions registered with ``peer=True``.
+    Usage:
+        >>> async def subscribe(peer, key):
+        >>>     subscribers[key].add(peer)
+        >>> rpc_server.register('subscribe', subscribe, peer=True)
+        >>> ...
+        >>> await peer.call('invalidate', key)
+
+    :param conn: Connection of the client.
+    :param float timeout: Timeout of every call, seconds.
+    :param dict pack_params: Parameters to pass to Messagepack Packer.
+    """
+
+    def __init__(self, conn, timeout, pack_params):
+        self._conn = conn
+        self._timeout = timeout
+        self._pack_params = pack_params
+        self._msg_id = 0
+        self._pending = {}
+
+    def getpeername(self):
+        return self._conn.peer
+
+    def is_closed(self):
+        return self._conn.is_closed()
+
+    def _next_msg_id(self):
+        msg_id = self._msg_id
+        while True:
+            msg_id = msg_id + 1 if msg_id < MSGPACKRPC_MAX_MSGID else 0
+            if msg_id not in self._pending:
+                self._msg_id = msg_id
+                return msg_id
+
+    async def call(self, method, *args):
+        """Calls a function registered on the client.
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        """
+        msg_id = self._next_msg_id()
+        req = msgpack.packb((MSGPACKRPC_REQUEST, msg_id, method, args),
+                            use_bin_type=False, **self._pack_params)
+        loop = asyncio.get_event_loop()
+        entry = self._pending[msg_id] = _PendingCall(loop.create_future())
+        if self._timeout:
+            get_timer_wheel(loop).schedule(self._timeout, entry)
+        try:
+            await self._conn.sendall(req, self._timeout)
+            return await entry.future
+        finally:
+            self._pending.pop(msg_id, None)
+
+    def _on_response(self, response):
+        _, msg_id, error, result = response
+        entry = self._pending.get(msg_id)
+        if entry is None or entry.future.done():
+            return
+        if error and len(error) == 2:
+            entry.future.set_exception(EnhancedRPCError(*error))
+        elif error:
+            entry.future.set_exception(RPCError(error))
+        else:
+            entry.future.set_result(result)
+
+    def _fail_pending(self, exc):
+        for entry in self._pending.values():
+            if not entry.future.done():
+                entry.future.set_exception(exc)
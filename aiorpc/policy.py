@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import random
+from collections import deque
+
+__all__ = ['RetryPolicy', 'HedgePolicy', 'BatchPolicy']
+
+
+class RetryPolicy:
+    """Retry policy of an idempotent method.
+    Usage:
+        >>> client = RPCClient('127.0.0.1', 6000,
+        >>>                    retry_policies={'get': RetryPolicy(attempts=3)})
+
+    Only failures of the transport are retried, errors raised by the remote
+    function are always returned to the caller.
+
+    :param int attempts: Total number of attempts, including the first one.
+    :param float backoff: Delay before the first retry in seconds. Doubled on
+        every following retry.
+    :param float max_backoff: Upper bound of the delay between two attempts.
+    :param tuple retry_on: Exception types worth another attempt.
+    """
+
+    def __init__(self, attempts=3, backoff=0.05, max_backoff=1.0,
+                 retry_on=(OSError, asyncio.TimeoutError)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+
+    def should_retry(self, exc, attempt):
+        """Return True if attempt number `attempt` (zero based) failing with
+        `exc` should be followed by another one."""
+        return attempt + 1 < self.attempts and isinstance(exc, self.retry_on)
+
+    def delay(self, attempt):
+        """Return the jittered delay to wait after attempt number `attempt`."""
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+class HedgePolicy:
+    """Hedging policy of an idempotent method.
+    When a call did not complete after `delay`, the same request is sent over
+    a second connection and the first answer wins.
+    Usage:
+        >>> client = RPCClient('127.0.0.1', 6000,
+        >>>                    hedge_policies={'get': HedgePolicy(percentile=95)})
+
+    :param float delay: (optional) Fixed hedging delay in seconds. When omitted
+        the delay is the `percentile` of the recently observed latencies.
+    :param float percentile: Latency percentile used as hedging delay.
+    :param int window: Number of recent latencies kept.
+    :param int min_samples: No hedging until that many latencies were observed.
+    """
+
+    def __init__(self, delay=None, percentile=95, window=100, min_samples=20):
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._threshold = None
+        self._refresh_every = max(1, window // 10)
+        self._observed = 0
+
+    def observe(self, latency):
+        """Record the latency of a completed call, in seconds."""
+        self._latencies.append(latency)
+        self._observed += 1
+        if self._observed % self._refresh_every == 0 and len(self._latencies) >= self.min_samples:
+            ordered = sorted(self._latencies)
+            index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+            self._threshold = ordered[index]
+
+    def threshold(self):
+        """Return the hedging delay in seconds, or None if the call should not
+        be hedged yet."""
+        return self.delay if self.delay is not None else self._threshold
+
+
+class BatchPolicy:
+    """Batching policy of a vectorized function.
+    Concurrent calls are collected and the function is invoked once with the
+    list of their argument tuples. It must return one result per call, an
+    Exception instance fails only the call it belongs to.
+    Usage:
+        >>> def score(batch):
+        >>>     return model.predict(numpy.array(batch)).tolist()
+        >>> rpc_server.register('score', score, batch=BatchPolicy(max_size=64, max_wait_ms=2))
+
+    :param int max_size: The batch is flushed as soon as it holds that many calls.
+    :param float max_wait_ms: Longest delay of the first call of a batch, milliseconds.
+    """
+
+    def __init__(self, max_size=64, max_wait_ms=1):
+        self.max_size = max_size
+        self.max_wait_ms = max_wait_ms
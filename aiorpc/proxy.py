@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import msgpack
+
+from aiorpc.connection import Connection
+from aiorpc.constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE, MSGPACKRPC_NOTIFY, \
+    MSGPACKRPC_MAX_MSGID, MAX_BUFFER_SIZE
+from aiorpc.exceptions import RPCProtocolError, ConnectionLostError
+from aiorpc.log import rootLogger
+from aiorpc.router import HashRing, _endpoint_name
+
+__all__ = ['RPCProxy']
+
+_logger = rootLogger.getChild(__name__)
+
+_INT_SIZES = {0xcc: 1, 0xcd: 2, 0xce: 4, 0xcf: 8, 0xd0: 1, 0xd1: 2, 0xd2: 4, 0xd3: 8}
+_STR_SIZES = {0xd9: 1, 0xda: 2, 0xdb: 4, 0xc4: 1, 0xc5: 2, 0xc6: 4}
+
+
+def _read_array_len(frame, pos):
+    tag = frame[pos]
+    if 0x90 <= tag <= 0x9f:
+        return tag & 0x0f, pos + 1
+    if tag == 0xdc:
+        return int.from_bytes(frame[pos + 1:pos + 3], 'big'), pos + 3
+    if tag == 0xdd:
+        return int.from_bytes(frame[pos + 1:pos + 5], 'big'), pos + 5
+    raise RPCProtocolError('Invalid protocol')
+
+
+def _read_int(frame, pos):
+    tag = frame[pos]
+    if tag < 0x80:
+        return tag, pos + 1
+    if tag >= 0xe0:
+        return tag - 0x100, pos + 1
+    if tag == 0xc0:
+        return None, pos + 1
+    size = _INT_SIZES.get(tag)
+    if size is None:
+        raise RPCProtocolError('Invalid protocol')
+    return int.from_bytes(frame[pos + 1:pos + 1 + size], 'big', signed=tag >= 0xd0), pos + 1 + size
+
+
+def _read_str(frame, pos):
+    tag = frame[pos]
+    if 0xa0 <= tag <= 0xbf:
+        size, pos = tag & 0x1f, pos + 1
+    elif tag in _STR_SIZES:
+        length = _STR_SIZES[tag]
+        size, pos = int.from_bytes(frame[pos + 1:pos + 1 + length], 'big'), pos + 1 + length
+    else:
+        raise RPCProtocolError('Invalid protocol')
+    return bytes(frame[pos:pos + size]).decode('utf-8', 'replace'), pos + size
+
+
+def _peek_header(frame, msg_type):
+    """Decode the ``[type, msg_id`` prefix of a frame, without touching the rest.
+
+    :return: ``(msg_id, start, end)``, `start` and `end` delimiting the encoded msg_id.
+    """
+    length, pos = _read_array_len(frame, 0)
+    if length != 4 or frame[pos] != msg_type:
+        raise RPCProtocolError('Invalid protocol')
+    msg_id, end = _read_int(frame, pos + 1)
+    return msg_id, pos + 1, end
+
+
+def _pack_msg_id(msg_id):
+    # always uint32, whatever the size of the original msg_id
+    return b'\xce' + msg_id.to_bytes(4, 'big')
+
+
+class _Upstream:
+    """One connection to a backend, shared by all the proxied clients.
+    Requests get a msg_id of this connection, responses are relayed back under
+    the msg_id the client chose."""
+
+    def __init__(self, endpoint, timeout, max_buffer_size, max_message_size):
+        self.endpoint = endpoint
+        self._timeout = timeout
+        self._max_buffer_size = max_buffer_size
+        self._max_message_size = max_message_size
+        self._conn = None
+        self._lock = None
+        self._msg_id = 0
+        # proxy msg_id -> (client connection, encoded client msg_id, client msg_id, backend connection)
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def _connect(self):
+        if self._conn is not None and not self._conn.is_closed():
+            return self._conn
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._conn is not None and not self._conn.is_closed():
+                return self._conn
+            if isinstance(self.endpoint, str):
+                future = asyncio.open_unix_connection(self.endpoint)
+            else:
+                future = asyncio.open_connection(*self.endpoint)
+            reader, writer = await asyncio.wait_for(future, self._timeout)
+            conn = Connection(reader, writer, msgpack.Unpacker(max_buffer_size=self._max_buffer_size),
+                              self._max_buffer_size, self._max_message_size)
+            self._conn = conn
+            asyncio.ensure_future(self._run(conn))
+            return conn
+
+    def _next_msg_id(self):
+        while True:
+            self._msg_id = self._msg_id + 1 if self._msg_id < MSGPACKRPC_MAX_MSGID else 0
+            if self._msg_id not in self._pending:
+                return self._msg_id
+
+    async def forward(self, client, frame, msg_id, start, end):
+        conn = await self._connect()
+        proxy_msg_id = self._next_msg_id()
+        self._pending[proxy_msg_id] = (client, bytes(frame[start:end]), msg_id, conn)
+        try:
+            # the arguments are copied once into the outgoing frame, never decoded
+            await conn.sendall(b''.join((frame[:start], _pack_msg_id(proxy_msg_id),
+                                         memoryview(frame)[end:])), self._timeout)
+        except Exception:
+            self._pending.pop(proxy_msg_id, None)
+            raise
+
+    async def _run(self, conn):
+        error = ConnectionLostError('Connection to {} closed'.format(_endpoint_name(self.endpoint)))
+        try:
+            while True:
+                frame = await conn.recv_frame()
+                if frame[:2] == bytes((0x93, MSGPACKRPC_NOTIFY)):
+                    # the backend is draining: new requests go over a new connection
+                    if self._conn is conn:
+                        self._conn = None
+                    continue
+                msg_id, start, end = _peek_header(frame, MSGPACKRPC_RESPONSE)
+                entry = self._pending.pop(msg_id, None)
+                if entry is None:
+                    if msg_id is None:
+                        _logger.warning("Backend %s failed the connection", _endpoint_name(self.endpoint))
+                    continue
+                client, raw_msg_id = entry[:2]
+                if client.writer.transport.is_closing():
+                    continue
+                # a slow client must not hold up the responses of the others
+                client.writer.write(b''.join((frame[:start], raw_msg_id, memoryview(frame)[end:])))
+        except RPCProtocolError as e:
+            error = e
+        except Exception as e:
+            error = ConnectionLostError('Connection to {} lost: {}'.format(
+                _endpoint_name(self.endpoint), e))
+        finally:
+            conn.close()
+            if self._conn is conn:
+                self._conn = None
+            lost = [key for key, entry in self._pending.items() if entry[3] is conn]
+            for key in lost:
+                client, _, msg_id, _ = self._pending.pop(key)
+                _send_error(client, error, msg_id)
+
+
+def _send_error(client, error, msg_id):
+    if client.writer.transport.is_closing():
+        return
+    response = (MSGPACKRPC_RESPONSE, msg_id, (type(error).__name__, str(error)), None)
+    client.writer.write(msgpack.packb(response, use_bin_type=False))
+
+
+class _Backend:
+    def __init__(self, endpoint, pool_size, upstream_params):
+        self.upstreams = [_Upstream(endpoint, **upstream_params) for _ in range(pool_size)]
+        self._next = 0
+
+    def inflight(self):
+        return sum(len(upstream) for upstream in self.upstreams)
+
+    def upstream(self):
+        upstream = self.upstreams[self._next]
+        self._next = (self._next + 1) % len(self.upstreams)
+        return upstream
+
+    def close(self):
+        for upstream in self.upstreams:
+            if upstream._conn is not None:
+                upstream._conn.close()
+
+
+class RPCProxy:
+    """Gateway relaying requests to backend servers without re-encoding them.
+    Usage:
+        >>> proxy = RPCProxy([('10.0.0.1', 6000), ('10.0.0.2', 6000)], key=0)
+        >>> await asyncio.start_server(proxy.serve, '0.0.0.0', 6000)
+
+    Only the frame header and the method name of a request are decoded. The
+    msg_id is rewritten into one of the backend connection and the original
+    bytes are forwarded, responses are relayed back the same way. Backend
+    connections are pooled and shared by all the clients.
+
+    :param endpoints: List of ``(host, port)`` tuples or unix socket paths.
+    :param key: (optional) How to route requests, as for RoutingClient. An int
+        picks the positional argument used as consistent hash key, a callable
+        gets ``(method, args)`` and returns the key. Either one makes the proxy
+        decode the arguments. Requests go to the least loaded backend when omitted.
+    :param int pool_size: Connections kept open to each backend.
+    :param float timeout: Timeout of backend connects and writes in seconds.
+    :param int replicas: Virtual points per backend on the hash ring.
+    :param int max_buffer_size: Bytes buffered per connection at most.
+    :param int max_message_size: (optional) Largest single frame accepted.
+    """
+
+    def __init__(self, endpoints, key=None, pool_size=1, timeout=3, replicas=100,
+                 max_buffer_size=MAX_BUFFER_SIZE, max_message_size=None):
+        self._key = key
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._max_buffer_size = max_buffer_size
+        self._max_message_size = max_message_size
+        self._ring = HashRing(replicas=replicas)
+        self._backends = {}
+        self._metrics = dict(connections=0, requests=0, errors=0)
+        self.set_endpoints(endpoints)
+
+    def set_endpoints(self, endpoints):
+        """Replace the backend list. Connections to kept backends are reused."""
+        endpoints = [e if isinstance(e, str) else tuple(e) for e in endpoints]
+        for endpoint in set(self._backends) - set(endpoints):
+            self._ring.remove(endpoint)
+            self._backends.pop(endpoint).close()
+        for endpoint in endpoints:
+            if endpoint not in self._backends:
+                self._backends[endpoint] = _Backend(
+                    endpoint, self._pool_size,
+                    dict(timeout=self._timeout, max_buffer_size=self._max_buffer_size,
+                         max_message_size=self._max_message_size))
+                self._ring.add(endpoint)
+
+    def get_metrics(self):
+        metrics = dict(self._metrics)
+        metrics['inflight'] = {_endpoint_name(endpoint): backend.inflight()
+                               for endpoint, backend in self._backends.items()}
+        return metrics
+
+    def route(self, frame, method, args_start):
+        """Return the backend endpoint of a request."""
+        if not self._backends:
+            raise LookupError('No endpoint available')
+        if self._key is None:
+            return min(self._backends, key=lambda e: self._backends[e].inflight())
+        args = msgpack.unpackb(memoryview(frame)[args_start:], raw=False, use_list=False)
+        key = self._key(method, args) if callable(self._key) else args[self._key]
+        return self._ring.get(key)
+
+    async def _forward(self, conn, frame):
+        try:
+            msg_id, start, end = _peek_header(frame, MSGPACKRPC_REQUEST)
+        except (RPCProtocolError, IndexError):
+            _send_error(conn, RPCProtocolError('Invalid protocol'), None)
+            return
+        self._metrics['requests'] += 1
+        try:
+            method, args_start = _read_str(frame, end)
+            endpoint = self.route(frame, method, args_start)
+            await self._backends[endpoint].upstream().forward(conn, frame, msg_id, start, end)
+        except Exception as e:
+            _logger.error("Forwarding request %s from %s failed: %s", msg_id, conn.peer, e)
+            self._metrics['errors'] += 1
+            _send_error(conn, e, msg_id)
+
+    async def serve(self, reader, writer):
+        """Serve function.
+        Don't use this outside asyncio.start_server.
+        """
+        conn = Connection(reader, writer, msgpack.Unpacker(max_buffer_size=self._max_buffer_size),
+                          self._max_buffer_size, self._max_message_size)
+        self._metrics['connections'] += 1
+        try:
+            while not conn.is_closed():
+                try:
+                    frame = await conn.recv_frame()
+                except RPCProtocolError as e:
+                    _logger.warning("Closing connection to %s: %s", conn.peer, e)
+                    _send_error(conn, e, None)
+                    break
+                except IOError:
+                    break
+                await self._forward(conn, frame)
+        finally:
+            conn.close()
+
+    def close(self):
+        for backend in self._backends.values():
+            backend.close()
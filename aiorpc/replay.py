@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Replay a traffic capture against a server.
+
+Usage::
+
+    % python -m aiorpc.replay requests.capture --host 127.0.0.1 --port 6000 --speed 10
+    % python -m aiorpc.replay requests.capture --path /tmp/rpc.sock --speed 0 --compare 10.0.0.2:6000
+"""
+import argparse
+import asyncio
+
+import msgpack
+
+from aiorpc.capture import read_capture
+from aiorpc.client import RPCClient
+from aiorpc.constants import MSGPACKRPC_REQUEST
+from aiorpc.exceptions import EnhancedRPCError, RPCError
+
+__all__ = ['replay', 'main']
+
+
+def _percentile(ordered, percentile):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+async def _outcome(client, method, args):
+    try:
+        return True, await client.call(method, *args)
+    except (EnhancedRPCError, RPCError) as e:
+        # the remote function failed, that is an answer worth comparing too
+        return True, repr(e)
+    except Exception as e:
+        return False, repr(e)
+
+
+async def replay(records, clients, speed=1.0, concurrency=100, compare_clients=None):
+    """Re-drive the requests of a capture.
+
+    :param records: ``(timestamp, connection id, raw frame)`` tuples, see read_capture.
+    :param clients: RPCClient pool. Requests of a captured connection always
+        go through the same client.
+    :param float speed: Multiplier of the captured pace, 0 sends as fast as possible.
+    :param int concurrency: Calls in flight at most.
+    :param compare_clients: (optional) Second RPCClient pool. Every request is
+        sent to it as well and the answers are compared.
+    :return: dict with calls, errors, mismatches, duration_s, qps and latency_ms.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    counters = dict(calls=0, errors=0, mismatches=0, skipped=0)
+    tasks = []
+
+    async def _one(index, method, args):
+        try:
+            start = loop.time()
+            ok, result = await _outcome(clients[index], method, args)
+            latencies.append(loop.time() - start)
+            counters['calls'] += 1
+            if not ok:
+                counters['errors'] += 1
+            if compare_clients is not None:
+                _, expected = await _outcome(compare_clients[index], method, args)
+                if expected != result:
+                    counters['mismatches'] += 1
+        finally:
+            semaphore.release()
+
+    start = loop.time()
+    first = None
+    for timestamp, conn_id, raw in records:
+        req = msgpack.unpackb(raw, raw=False, use_list=False)
+        if not isinstance(req, tuple) or len(req) != 4 or req[0] != MSGPACKRPC_REQUEST:
+            counters['skipped'] += 1
+            continue
+        if first is None:
+            first = timestamp
+        if speed:
+            delay = (timestamp - first) / speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await semaphore.acquire()
+        _, _, method, args = req
+        tasks.append(asyncio.ensure_future(_one(conn_id % len(clients), method, args)))
+    await asyncio.gather(*tasks)
+
+    duration = loop.time() - start
+    ordered = sorted(latencies)
+    report = dict(counters, duration_s=duration,
+                  qps=counters['calls'] / duration if duration else 0.0,
+                  latency_ms=dict(mean=sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+                                  p50=_percentile(ordered, 50) * 1000,
+                                  p90=_percentile(ordered, 90) * 1000,
+                                  p99=_percentile(ordered, 99) * 1000,
+                                  max=ordered[-1] * 1000 if ordered else 0.0))
+    return report
+
+
+def _make_clients(size, host=None, port=None, path=None, timeout=3):
+    return [RPCClient(host, port, path, timeout=timeout) for _ in range(size)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m aiorpc.replay',
+                                     description='Replay an aiorpc traffic capture.')
+    parser.add_argument('capture', help='capture file written by TrafficCapture')
+    parser.add_argument('--host', help='server host')
+    parser.add_argument('--port', type=int, help='server port')
+    parser.add_argument('--path', help='server unix socket path')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='multiplier of the captured pace, 0 for as fast as possible')
+    parser.add_argument('--clients', type=int, default=4, help='connections used')
+    parser.add_argument('--concurrency', type=int, default=100, help='calls in flight at most')
+    parser.add_argument('--timeout', type=float, default=3, help='timeout of every call')
+    parser.add_argument('--compare', metavar='HOST:PORT|PATH',
+                        help='second server receiving every request, answers are compared')
+    args = parser.parse_args(argv)
+    if not args.path and not (args.host and args.port):
+        parser.error('either --path or --host and --port are required')
+
+    clients = _make_clients(args.clients, args.host, args.port, args.path, args.timeout)
+    compare_clients = None
+    if args.compare:
+        host, sep, port = args.compare.rpartition(':')
+        if sep and port.isdigit():
+            compare_clients = _make_clients(args.clients, host, int(port), timeout=args.timeout)
+        else:
+            compare_clients = _make_clients(args.clients, path=args.compare, timeout=args.timeout)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        report = loop.run_until_complete(replay(read_capture(args.capture), clients, args.speed,
+                                                args.concurrency, compare_clients))
+    finally:
+        for client in clients + (compare_clients or []):
+            client.close()
+        loop.close()
+
+    print('calls: %d, errors: %d, skipped: %d, mismatches: %d' % (
+        report['calls'], report['errors'], report['skipped'], report['mismatches']))
+    print('duration: %.3fs, %d qps' % (report['duration_s'], report['qps']))
+    print('latency ms: mean %(mean).3f p50 %(p50).3f p90 %(p90).3f p99 %(p99).3f max %(max).3f'
+          % report['latency_ms'])
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import hashlib
+import os
+
+import msgpack
+
+from aiorpc.client import RPCClient
+from aiorpc.log import rootLogger
+
+__all__ = ['HashRing', 'RoutingClient', 'endpoints_from_file']
+
+_logger = rootLogger.getChild(__name__)
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.md5(data).digest()[:8], 'big')
+
+
+def _endpoint_name(endpoint):
+    if isinstance(endpoint, str):
+        return endpoint
+    return '{}:{}'.format(*endpoint)
+
+
+class HashRing:
+    """Consistent hash ring.
+    Adding or removing a node only remaps the keys owned by that node.
+
+    :param nodes: (optional) Initial nodes, any msgpack serializable value.
+    :param int replicas: Virtual points per node. More points spread the keys
+        more evenly.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._owners = []
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        name = msgpack.packb(node)
+        for i in range(self.replicas):
+            point = _hash(name + i.to_bytes(4, 'big'))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        kept = [(p, n) for p, n in zip(self._points, self._owners) if n != node]
+        self._points = [p for p, _ in kept]
+        self._owners = [n for _, n in kept]
+
+    def get(self, key):
+        """Return the node owning `key`, any msgpack serializable value."""
+        if not self._points:
+            raise LookupError('Hash ring is empty')
+        index = bisect.bisect(self._points, _hash(msgpack.packb(key)))
+        return self._owners[index % len(self._owners)]
+
+
+def endpoints_from_file(path):
+    """Build an endpoint provider reading `path` whenever it changed.
+    Every line holds either ``host:port`` or a unix socket path.
+    Usage:
+        >>> client = RoutingClient(refresher=endpoints_from_file('/etc/cache.nodes'))
+
+    :param path: File to watch.
+    :return: A callable returning the endpoint list, or None when unchanged.
+    """
+    last_mtime = None
+
+    def _read():
+        nonlocal last_mtime
+        mtime = os.stat(path).st_mtime
+        if mtime == last_mtime:
+            return None
+        last_mtime = mtime
+        endpoints = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                host, sep, port = line.rpartition(':')
+                endpoints.append((host, int(port)) if sep and port.isdigit() else line)
+        return endpoints
+
+    return _read
+
+
+class _Node:
+    def __init__(self, endpoint, pool_size, client_params):
+        if isinstance(endpoint, str):
+            self.clients = [RPCClient(path=endpoint, **client_params) for _ in range(pool_size)]
+        else:
+            host, port = endpoint
+            self.clients = [RPCClient(host, port, **client_params) for _ in range(pool_size)]
+        self.inflight = 0
+        self._next = 0
+
+    def client(self):
+        client = self.clients[self._next]
+        self._next = (self._next + 1) % len(self.clients)
+        return client
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+class RoutingClient:
+    """RPC client spreading calls over many servers.
+    Usage:
+        >>> client = RoutingClient([('10.0.0.1', 6000), ('10.0.0.2', 6000)], key=0)
+        >>> await client.call('cache.get', 'user:42')  # routed by 'user:42'
+
+    :param endpoints: (optional) List of ``(host, port)`` tuples or unix socket paths.
+    :param key: (optional) How to route calls. An int picks the positional argument
+        used as consistent hash key, a callable gets ``(method, args)`` and returns
+        the key. Calls are sent to the least loaded server when omitted.
+    :param int pool_size: Connections kept open to each server.
+    :param refresher: (optional) Callable, or coroutine function, returning the
+        current endpoint list, or None if unchanged. Polled every `refresh_interval`.
+    :param float refresh_interval: Seconds between two refresher polls.
+    :param int replicas: Virtual points per server on the hash ring.
+    :param client_params: Passed to every RPCClient.
+    """
+
+    def __init__(self, endpoints=(), key=None, pool_size=1, refresher=None,
+                 refresh_interval=5, replicas=100, **client_params):
+        self._key = key
+        self._pool_size = pool_size
+        self._client_params = client_params
+        self._refresher = refresher
+        self._refresh_interval = refresh_interval
+        self._refresh_task = None
+        self._ring = HashRing(replicas=replicas)
+        self._nodes = {}
+        self.set_endpoints(endpoints)
+
+    def endpoints(self):
+        return list(self._nodes)
+
+    def set_endpoints(self, endpoints):
+        """Replace the server list. Connections to kept servers are reused."""
+        endpoints = [e if isinstance(e, str) else tuple(e) for e in endpoints]
+        for endpoint in set(self._nodes) - set(endpoints):
+            _logger.info("Removing endpoint %s", _endpoint_name(endpoint))
+            self._ring.remove(endpoint)
+            self._nodes.pop(endpoint).close()
+        for endpoint in endpoints:
+            if endpoint not in self._nodes:
+                _logger.info("Adding endpoint %s", _endpoint_name(endpoint))
+                self._nodes[endpoint] = _Node(endpoint, self._pool_size, self._client_params)
+                self._ring.add(endpoint)
+
+    async def refresh(self):
+        """Poll the refresher once."""
+        endpoints = self._refresher()
+        if asyncio.iscoroutine(endpoints):
+            endpoints = await endpoints
+        if endpoints is not None:
+            self.set_endpoints(endpoints)
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                _logger.error("Refreshing endpoints failed: %s", e)
+
+    def route(self, method, args):
+        """Return the endpoint a call would be sent to."""
+        if not self._nodes:
+            raise LookupError('No endpoint available')
+        if self._key is None:
+            return min(self._nodes, key=lambda e: self._nodes[e].inflight)
+        key = self._key(method, args) if callable(self._key) else args[self._key]
+        return self._ring.get(key)
+
+    async def call(self, method, *args, _key=None):
+        """Calls a RPC method on the server selected by the routing rule.
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param _key: (optional) Consistent hash key overriding the routing rule.
+        """
+        if self._refresher is not None and self._refresh_task is None:
+            await self.refresh()
+            self._refresh_task = asyncio.ensure_future(self._refresh_forever())
+        endpoint = self._ring.get(_key) if _key is not None else self.route(method, args)
+        node = self._nodes[endpoint]
+        node.inflight += 1
+        try:
+            return await node.client().call(method, *args)
+        finally:
+            node.inflight -= 1
+
+    def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        for node in self._nodes.values():
+            node.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from collections import OrderedDict, deque
+
+from aiorpc.exceptions import LaneFullError
+from aiorpc.log import rootLogger
+
+__all__ = ['Lane', 'Scheduler']
+
+_logger = rootLogger.getChild(__name__)
+
+
+class Lane:
+    """Priority class of requests.
+
+    :param str name: Lane name.
+    :param float weight: Share of the dispatch slots relative to the other lanes.
+    :param int concurrency: (optional) Requests of this lane running at once.
+        Unlimited when omitted.
+    :param int max_queue: (optional) Requests of this lane waiting at most,
+        further ones are rejected with LaneFullError.
+    """
+
+    def __init__(self, name, weight=1, concurrency=None, max_queue=None):
+        self.name = name
+        self.weight = weight
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        # one queue per connection, served round robin
+        self._queues = OrderedDict()
+        self._pass = 0.0
+
+    def _has_room(self):
+        return self.concurrency is None or self.running < self.concurrency
+
+    def _push(self, key, job):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(job)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.queued)
+
+    def _pop(self):
+        key, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        if queue:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        self.queued -= 1
+        return job
+
+    def _discard(self, key):
+        queue = self._queues.pop(key, None)
+        if queue:
+            self.queued -= len(queue)
+        return queue or ()
+
+    def metrics(self):
+        return dict(queued=self.queued, running=self.running, completed=self.completed,
+                    rejected=self.rejected, max_depth=self.max_depth)
+
+
+class Scheduler:
+    """Weighted fair scheduler sitting between request decoding and dispatch.
+    Lanes get dispatch slots in proportion to their weight, and inside a lane
+    connections are served round robin so that a single heavy client can't
+    starve the others.
+    Usage:
+        >>> scheduler = Scheduler([Lane('control', weight=4, concurrency=4),
+        >>>                        Lane('bulk', weight=1, concurrency=2, max_queue=1000)],
+        >>>                       methods={'health': 'control'}, default='bulk')
+        >>> rpc_server = RPCServer(scheduler=scheduler)
+
+    :param lanes: Lane objects.
+    :param dict methods: (optional) Method name to lane name.
+    :param str default: (optional) Lane of the methods not listed. Defaults to
+        the first lane.
+    :param classify: (optional) Callable getting ``(method_name, args)`` and
+        returning a lane name or None, e.g. to pick the lane from an argument
+        acting as request header. Overrides `methods`.
+    """
+
+    def __init__(self, lanes, methods=None, default=None, classify=None):
+        self.lanes = OrderedDict((lane.name, lane) for lane in lanes)
+        if not self.lanes:
+            raise ValueError('Scheduler needs at least one lane')
+        self._methods = dict(methods or {})
+        self._default = self.lanes[default] if default is not None else next(iter(self.lanes.values()))
+        self._classify = classify
+        self._virtual_time = 0.0
+
+    def assign(self, method_name, lane_name):
+        """Route a method to a lane."""
+        if lane_name not in self.lanes:
+            raise KeyError('No such lane {}'.format(lane_name))
+        self._methods[method_name] = lane_name
+
+    def lane_of(self, method_name, args):
+        name = None
+        if self._classify is not None:
+            name = self._classify(method_name, args)
+        if name is None:
+            name = self._methods.get(method_name)
+        return self.lanes.get(name, self._default) if name is not None else self._default
+
+    def submit(self, lane, key, job):
+        """Queue `job`, a callable returning an awaitable, in `lane` on behalf
+        of connection `key`.
+
+        :raises LaneFullError: when the queue of the lane is full.
+        """
+        if lane.max_queue is not None and lane.queued >= lane.max_queue:
+            lane.rejected += 1
+            raise LaneFullError('Lane {} is full'.format(lane.name))
+        if not lane.queued:
+            # a lane becoming busy does not get credit for the time it was idle
+            lane._pass = max(lane._pass, self._virtual_time)
+        lane._push(key, job)
+        self._pump()
+
+    def discard(self, key):
+        """Drop the queued jobs of connection `key`, e.g. once it closed."""
+        for lane in self.lanes.values():
+            lane._discard(key)
+
+    def _pump(self):
+        while True:
+            ready = [lane for lane in self.lanes.values() if lane.queued and lane._has_room()]
+            if not ready:
+                return
+            lane = min(ready, key=lambda l: l._pass)
+            self._virtual_time = lane._pass
+            lane._pass += 1.0 / lane.weight
+            job = lane._pop()
+            lane.running += 1
+            asyncio.ensure_future(self._run(lane, job))
+
+    async def _run(self, lane, job):
+        try:
+            await job()
+        except Exception as e:
+            _logger.error("Job of lane %s failed: %s", lane.name, e)
+        finally:
+            lane.running -= 1
+            lane.completed += 1
+            self._pump()
+
+    def metrics(self):
+        """Return the counters of every lane."""
+        return {name: lane.metrics() for name, lane in self.lanes.items()}
@@ -1,25 +1,749 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import functools
 import msgpack
 import datetime
-
-from aiorpc.constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE
-from aiorpc.exceptions import MethodNotFoundError, RPCProtocolError, MethodRegisteredError
+import secrets
+import time
+import weakref
+
+from aiorpc.constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE, MSGPACKRPC_NOTIFY, \
+    MAX_BUFFER_SIZE, MIGRATE_METHOD
+from aiorpc.exceptions import MethodNotFoundError, RPCProtocolError, MethodRegisteredError, \
+    EnhancedRPCError, LaneFullError, ConnectionLostError
 from aiorpc.connection import Connection
+from aiorpc.diagnostics import DIAGNOSTICS_METHOD
+from aiorpc.fileregion import FileRegion, FD_CHANNEL_METHOD, FD_EXT_TYPE, _FdChannel, _is_unix_socket
+from aiorpc.interceptor import match_methods, compose
 from aiorpc.log import rootLogger
+from aiorpc.peer import Peer
 
-__all__ = ['register', 'msgpack_init', 'set_timeout', 'serve', 'register_class']
+__all__ = ['RPCServer', 'register', 'msgpack_init', 'set_timeout', 'set_limits', 'serve',
+           'register_class']
 
 _logger = rootLogger.getChild(__name__)
-_methods = dict()
-_class_methods = dict()
-_pack_params = dict()
-_unpack_params = dict(use_list=False)
-_timeout = 3
 
 
-def register(name, f):
-    """Register a function on the RPC server.
+class _Batcher:
+    """Collects the calls of a batched function, see BatchPolicy."""
+
+    def __init__(self, server, method_name, policy):
+        self._server = server
+        self._method_name = method_name
+        self._policy = policy
+        self._items = []
+        self._timer = None
+
+    def submit(self, args):
+        future = asyncio.get_event_loop().create_future()
+        self._items.append((args, future))
+        if len(self._items) >= self._policy.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self._policy.max_wait_ms / 1000, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        if items:
+            # looked up now, a batch collected before a swap_methods runs the old function
+            f = self._server._lookup(self._method_name)
+            asyncio.ensure_future(self._run(items, f))
+
+    async def _run(self, items, f):
+        _logger.debug('calling `%s` with a batch of %d', self._method_name, len(items))
+        try:
+            results = await self._server._invoke(f, ([args for args, _ in items],))
+            if len(results) != len(items):
+                raise ValueError("Batched function `{}` returned {} results for {} calls".format(
+                    self._method_name, len(results), len(items)))
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class RPCServer:
+    """RPC server.
+    Every instance has its own dispatch table and settings, so servers with
+    different tuning can run side by side in one process.
+    Usage:
+        >>> rpc_server = RPCServer(timeout=1)
+        >>> rpc_server.register('echo', echo)
+        >>> await asyncio.start_server(rpc_server.serve, '127.0.0.1', 6000)
+
+    :param float timeout: (optional) Request timeout in seconds, bounding the
+        coroutine functions and the writes of their results.
+    :param float idle_timeout: (optional) Seconds a connection may stay silent
+        before it is closed. Defaults to `timeout`.
+    :param dict pack_params: (optional) Parameters to pass to Messagepack Packer.
+    :param dict unpack_params: (optional) Parameters to pass to Messagepack Unpacker.
+    :param int max_buffer_size: (optional) Bytes buffered per connection at most.
+        Defaults to 100MiB.
+    :param int max_message_size: (optional) Largest encoded request accepted.
+    :param executor: (optional) concurrent.futures.Executor running the plain
+        (non coroutine) functions. They run on the event loop when omitted.
+    :param scheduler: (optional) Scheduler assigning requests to priority lanes.
+        Without it every connection runs its requests one after the other.
+    :param diagnostics: (optional) Diagnostics recording loop lag and slow calls.
+    :param capture: (optional) TrafficCapture recording the raw request frames.
+    :param interceptors: (optional) Interceptors applied to every method, see
+        add_interceptor.
+    """
+
+    def __init__(self, timeout=3, pack_params=None, unpack_params=None,
+                 max_buffer_size=None, max_message_size=None, executor=None,
+                 idle_timeout=None, scheduler=None, diagnostics=None, capture=None,
+                 interceptors=None):
+        self._methods = dict()
+        self._class_methods = dict()
+        self._batchers = dict()
+        # methods getting the Peer handle of the connection as first argument
+        self._peer_methods = set()
+        self._interceptors = []
+        # method name -> interceptor chain, only for the methods intercepted
+        self._chains = dict()
+        self._pack_params = pack_params or dict()
+        self._unpack_params = unpack_params or dict(use_list=False)
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._max_buffer_size = max_buffer_size or MAX_BUFFER_SIZE
+        self._max_message_size = max_message_size
+        self._executor = executor
+        self._scheduler = scheduler
+        self._diagnostics = diagnostics
+        self._capture = capture
+        self._metrics = dict(connections=0, idle_closed=0, requests=0, errors=0,
+                             tls_handshakes=0, tls_resumed=0)
+        self._connections = set()
+        self._sweeper = None
+        self._draining = False
+        # token -> connection waiting for its fd channel
+        self._fd_channel_tokens = weakref.WeakValueDictionary()
+        for interceptor in interceptors or ():
+            self.add_interceptor(interceptor)
+        if diagnostics is not None:
+            diagnostics.install(self)
+
+    def register(self, name, f, batch=None, peer=False):
+        """Register a function on the RPC server.
+        Usage:
+            >>> def sum(x, y):
+            >>>     return x + y
+            >>> rpc_server.register('sum', sum)
+
+        :param name: The remote name of the function, can be different with the f.__name__.
+        :param f: Function object. Must be a callable object or a coroutine object.
+        :param batch: (optional) BatchPolicy. When given, concurrent calls from all
+                connections are collected and f is called once with the list of
+                their argument tuples, see BatchPolicy.
+        :param peer: (optional) Pass f a Peer handle calling the functions the
+                client registered as first argument. f runs concurrently with
+                the following requests of the connection, so that the client
+                can answer while f waits.
+        :return: None
+        """
+        if not hasattr(f, "__call__"):
+            raise MethodRegisteredError("{} is not a callable object".format(f.__name__))
+        if name in self._methods:
+            raise MethodRegisteredError("Name {} has already been used".format(name))
+        if batch is not None and peer:
+            raise MethodRegisteredError("Batched function {} can't get the peer".format(name))
+        self._methods[name] = f
+        if peer:
+            self._peer_methods.add(name)
+        if batch is not None:
+            self._batchers[name] = _Batcher(self, name, batch)
+        if self._interceptors:
+            self._compile(name, f)
+
+    def register_class(self, cls):
+        """
+        Registers a class on the RPC server. Methods can be accessed by ClassName.Method
+        :param cls: class to load
+        :return:
+        """
+        name = cls.__name__
+        _logger.info("Loaded class `%s`", name)
+        if name in self._class_methods:
+            raise MethodRegisteredError("Class {} has already been loaded".format(name))
+        self._class_methods[name] = instance = cls()
+        if self._interceptors:
+            for method_name, method in self._public_methods(name, instance):
+                self._compile(method_name, method)
+
+    def add_interceptor(self, interceptor, methods=None):
+        """Add an interceptor around the methods of the RPC server.
+        Usage:
+            >>> async def check_token(method_name, args, proceed):
+            >>>     if not valid(args[0]):
+            >>>         raise PermissionError('Invalid token')
+            >>>     return await proceed(*args[1:])
+            >>> rpc_server.add_interceptor(check_token, methods=lambda name: name.startswith('Admin.'))
+
+        Interceptors are coroutine functions getting the method name, the
+        argument tuple and `proceed`, calling the next interceptor or the
+        method itself. The interceptors of a method are composed into a single
+        chain right here, or when the method is registered later on. Methods
+        no interceptor applies to are dispatched as before, at no extra cost.
+        A batched method is intercepted once per batch, with the list of the
+        argument tuples as single argument. The first interceptor added is the
+        outermost one.
+
+        :param interceptor: Coroutine function ``(method_name, args, proceed)``.
+        :param methods: (optional) Method names, or a callable getting a method
+            name and returning a bool. Defaults to every method.
+        :return: None
+        """
+        self._interceptors.append((interceptor, match_methods(methods)))
+        self._chains = self._compile_all(self._methods, self._class_methods)
+
+    def swap_methods(self, staging):
+        """Replace the registered functions and classes at once, without
+        touching the connections.
+        Usage:
+            >>> staging = RPCServer()
+            >>> staging.register('sum', new_sum)
+            >>> staging.register_class(NewCalculator)
+            >>> rpc_server.swap_methods(staging)
+
+        Requests received from now on are dispatched to the functions of
+        `staging`, calls in progress finish with the old ones. Only the
+        dispatch table is taken from `staging`, the settings, interceptors and
+        diagnostics of this server stay in place.
+
+        :param staging: RPCServer used to register the new functions and classes.
+        :return: None
+        """
+        methods = dict(staging._methods)
+        class_methods = dict(staging._class_methods)
+        if self._diagnostics is not None and DIAGNOSTICS_METHOD in self._methods:
+            methods.setdefault(DIAGNOSTICS_METHOD, self._methods[DIAGNOSTICS_METHOD])
+        batchers = {name: _Batcher(self, name, batcher._policy)
+                    for name, batcher in staging._batchers.items()}
+        chains = self._compile_all(methods, class_methods) if self._interceptors else dict()
+        old_batchers = self._batchers
+        # no await from here on, requests see either the old or the new table
+        self._methods, self._class_methods = methods, class_methods
+        self._batchers, self._peer_methods = batchers, set(staging._peer_methods)
+        self._chains = chains
+        for batcher in old_batchers.values():
+            batcher._flush()
+        _logger.info("Swapped in %d functions and %d classes", len(methods), len(class_methods))
+
+    def _compile_all(self, methods, class_methods):
+        chains = dict()
+        for name, f in methods.items():
+            chain = compose(name, self._as_coroutine_function(f), self._interceptors)
+            if chain is not None:
+                chains[name] = chain
+        for class_name, instance in class_methods.items():
+            for name, method in self._public_methods(class_name, instance):
+                chain = compose(name, self._as_coroutine_function(method), self._interceptors)
+                if chain is not None:
+                    chains[name] = chain
+        return chains
+
+    @staticmethod
+    def _public_methods(class_name, instance):
+        for attr in dir(instance):
+            method = getattr(instance, attr)
+            if not attr.startswith('_') and callable(method):
+                yield '{}.{}'.format(class_name, attr), method
+
+    def _compile(self, name, f):
+        chain = compose(name, self._as_coroutine_function(f), self._interceptors)
+        if chain is None:
+            self._chains.pop(name, None)
+        else:
+            self._chains[name] = chain
+
+    def _as_coroutine_function(self, f):
+        # innermost link of a chain, runs f the way _invoke does
+        async def call(*args):
+            if self._executor is not None and not asyncio.iscoroutinefunction(f):
+                return await asyncio.get_event_loop().run_in_executor(
+                    self._executor, functools.partial(f, *args))
+            ret = f(*args)
+            if asyncio.iscoroutine(ret) or asyncio.isfuture(ret):
+                ret = await ret
+            return ret
+        return call
+
+    def msgpack_init(self, **kwargs):
+        """Init parameters of msgpack packer and unpacker.
+        Usage:
+            >>> rpc_server.msgpack_init(unicode_errors='backslashreplace')
+        :param kwargs: See https://msgpack-python.readthedocs.io/en/latest/api.html
+                default:
+                pack_params=dict()
+                unpack_params=dict(use_list=False)
+        :return: None
+        """
+        self._pack_params = kwargs.pop('pack_params', dict())
+        self._unpack_params = kwargs.pop('unpack_params', dict(use_list=False))
+
+    def set_timeout(self, timeout, idle_timeout=None):
+        """Set the IO timeout
+        Usage:
+            >>> rpc_server.set_timeout(1, idle_timeout=300)
+
+        :param timeout: Request timeout. Seconds.
+        :param idle_timeout: Idle connection timeout. Seconds. Defaults to timeout.
+        :return: None
+        """
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+
+    def set_limits(self, max_buffer_size=None, max_message_size=None):
+        """Set the per-connection memory limits.
+        A client exceeding a limit gets an RPCProtocolError and is disconnected.
+        Usage:
+            >>> rpc_server.set_limits(max_buffer_size=8 * 1024 ** 2, max_message_size=1024 ** 2)
+
+        :param max_buffer_size: Bytes buffered per connection at most. Defaults to 100MiB.
+        :param max_message_size: Largest encoded request accepted. Defaults to no limit
+                other than max_buffer_size.
+        :return: None
+        """
+        self._max_buffer_size = max_buffer_size or MAX_BUFFER_SIZE
+        self._max_message_size = max_message_size
+
+    def get_metrics(self):
+        """Return a snapshot of the server counters.
+
+        :return: dict with connections (accepted so far), active_connections,
+            idle_connections (no request in progress), idle_closed, requests,
+            errors, tls_handshakes and tls_resumed (handshakes resuming a
+            session), plus lanes when a scheduler is used.
+        """
+        metrics = dict(self._metrics)
+        metrics['active_connections'] = len(self._connections)
+        metrics['idle_connections'] = sum(1 for c in self._connections if not c.pending)
+        if self._scheduler is not None:
+            metrics['lanes'] = self._scheduler.metrics()
+        return metrics
+
+    async def start_server(self, host=None, port=None, path=None, ssl=None, **kwargs):
+        """Start serving on a TCP port or a unix socket.
+        Usage:
+            >>> context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            >>> context.load_cert_chain('server.pem')
+            >>> listener = await rpc_server.start_server('0.0.0.0', 6000, ssl=context)
+
+        :param host: Interface to listen on.
+        :param port: Port number.
+        :param path: Unix socket path. Either this one or host and port are required.
+        :param ssl: (optional) ssl.SSLContext enabling TLS. The default server
+            context issues session tickets, letting clients resume sessions.
+        :param kwargs: Passed to asyncio.start_server or asyncio.start_unix_server.
+        :return: asyncio.Server, see drain.
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self.serve, path, ssl=ssl, **kwargs)
+        return await asyncio.start_server(self.serve, host, port, ssl=ssl, **kwargs)
+
+    async def drain(self, *listeners, migrate_to=None, timeout=30, grace=0.1):
+        """Stop serving without dropping requests, e.g. before a deploy.
+        Usage:
+            >>> listener = await asyncio.start_server(rpc_server.serve, '0.0.0.0', 6000)
+            >>> ...
+            >>> await rpc_server.drain(listener)
+
+        - The `listeners` stop accepting connections, connections accepted
+          anyway are closed right away.
+        - Every client gets a migrate notification. RPCClient sends the calls
+          following it over a new connection, to `migrate_to` when given.
+        - A connection is closed once its calls completed and it stayed silent
+          for `grace` seconds, so requests already on the wire are served.
+          The connections left after `timeout` seconds are closed anyway.
+
+        :param listeners: asyncio.Server objects serving this server.
+        :param migrate_to: (optional) ``(host, port)`` or unix socket path the
+            clients should connect to. They reconnect to the same address when omitted.
+        :param float timeout: Seconds to wait for the calls in progress.
+        :param float grace: Seconds a connection must stay silent before it is closed.
+        :return: The number of connections closed with calls still in progress.
+        """
+        self._draining = True
+        for listener in listeners:
+            listener.close()
+        notification = msgpack.packb((MSGPACKRPC_NOTIFY, MIGRATE_METHOD, (migrate_to,)),
+                                     use_bin_type=False, **self._pack_params)
+        for conn in list(self._connections):
+            try:
+                await conn.sendall(notification, self._timeout)
+            except Exception as e:
+                _logger.warning("Exception %s raised when asking %s to migrate", e, conn.peer)
+
+        deadline = time.monotonic() + timeout
+        while self._connections and time.monotonic() < deadline:
+            quiet_since = time.monotonic() - grace
+            for conn in [c for c in self._connections if not c.pending and c.last_activity < quiet_since]:
+                self._connections.discard(conn)
+                conn.close()
+            if self._connections:
+                await asyncio.sleep(min(grace, 0.01))
+        forced = len(self._connections)
+        if forced:
+            _logger.warning("Closing %d connections with calls in progress", forced)
+        for conn in list(self._connections):
+            conn.close()
+        return forced
+
+    def _get_idle_timeout(self):
+        return self._idle_timeout if self._idle_timeout is not None else self._timeout
+
+    async def _sweep_idle_connections(self):
+        # A single task checks the last activity of every connection, instead of
+        # arming a timer for every read of every connection.
+        while self._connections:
+            idle_timeout = self._get_idle_timeout()
+            await asyncio.sleep(max(idle_timeout / 4, 0.01))
+            deadline = time.monotonic() - idle_timeout
+            for conn in [c for c in self._connections
+                         if not c.pending and c.last_activity < deadline]:
+                _logger.warning("Client %s did not send any data before timeout. Closing connection...",
+                                conn.peer)
+                self._metrics['idle_closed'] += 1
+                conn.close()
+        self._sweeper = None
+
+    async def _send_error(self, conn, exception, error, msg_id):
+        response = (MSGPACKRPC_RESPONSE, msg_id, (exception, error), None)
+        try:
+            await conn.sendall(msgpack.packb(response, use_bin_type=False, **self._pack_params),
+                               self._timeout)
+        except asyncio.TimeoutError as te:
+            _logger.error("Timeout when _send_error %s to %s",
+                error, conn.writer.get_extra_info('peername')
+            )
+        except Exception as e:
+            _logger.error("Exception %s raised when _send_error %s to %s",
+                e, error, conn.writer.get_extra_info("peername")
+            )
+
+    async def _send_result(self, conn, result, msg_id):
+        _logger.debug('entering _send_result')
+        if isinstance(result, FileRegion):
+            await self._send_file(conn, result, msg_id)
+            return
+        response = (MSGPACKRPC_RESPONSE, msg_id, None, result)
+        try:
+            _logger.debug('begin to sendall')
+            ret = msgpack.packb(response, use_bin_type=False, **self._pack_params)
+            await conn.sendall(ret, self._timeout)
+            _logger.debug('sendall completed')
+        except asyncio.TimeoutError as te:
+            _logger.error("Timeout when _send_result %s to %s",
+                result, conn.writer.get_extra_info('peername'))
+        except Exception as e:
+            _logger.error("Exception %s raised when _send_result %s to %s",
+                e, result, conn.writer.get_extra_info("peername")
+            )
+
+    async def _send_file(self, conn, region, msg_id):
+        try:
+            with region:
+                size = region.size()
+                if conn.fd_channel is not None:
+                    seq = conn.fd_channel.send(region.fileno())
+                    result = msgpack.ExtType(FD_EXT_TYPE, msgpack.packb((seq, region.offset, size)))
+                    await conn.sendall(msgpack.packb((MSGPACKRPC_RESPONSE, msg_id, None, result),
+                                                     use_bin_type=False, **self._pack_params),
+                                       self._timeout)
+                    return
+                # a response whose result is a bin32 header, the content follows as is
+                header = b''.join((b'\x94', msgpack.packb(MSGPACKRPC_RESPONSE), msgpack.packb(msg_id),
+                                   b'\xc0\xc6', size.to_bytes(4, 'big')))
+                await conn.sendfile(header, region.open(), region.offset, size)
+        except Exception as e:
+            _logger.error("Exception %s raised when _send_file to %s", e, conn.peer)
+            self._metrics['errors'] += 1
+            await self._send_error(conn, type(e).__name__, str(e), msg_id)
+
+    async def _open_fd_channel(self, conn, msg_id, args):
+        # called first on the main connection of a client to get a token, then
+        # on a second connection presenting the token, which becomes the fd channel
+        if not _is_unix_socket(conn):
+            await self._send_error(conn, 'RPCError', 'File descriptors need a unix socket', msg_id)
+        elif not args:
+            token = secrets.token_hex(16)
+            self._fd_channel_tokens[token] = conn
+            await self._send_result(conn, token, msg_id)
+        else:
+            main = self._fd_channel_tokens.pop(args[0], None)
+            if main is None or main.is_closed():
+                await self._send_error(conn, 'RPCError', 'Unknown fd channel token', msg_id)
+                return
+            main.fd_channel = _FdChannel(conn)
+            # never sends requests, it lives as long as the main connection
+            self._connections.discard(conn)
+            await self._send_result(conn, True, msg_id)
+
+    def _parse_request(self, req):
+        if len(req) != 4 or req[0] != MSGPACKRPC_REQUEST:
+            raise RPCProtocolError('Invalid protocol')
+
+        _, msg_id, method_name, args = req
+
+        return msg_id, self._lookup(method_name), args, method_name
+
+    def _lookup(self, method_name):
+        if self._chains:
+            chain = self._chains.get(method_name)
+            if chain is not None:
+                return chain
+        _method_soup = method_name.split('.')
+        if len(_method_soup) == 1:
+            method = self._methods.get(method_name)
+        else:
+            method = getattr(self._class_methods.get(_method_soup[0]), _method_soup[1], None)
+
+        if not method:
+            raise MethodNotFoundError("No such method {}".format(method_name))
+
+        return method
+
+    async def _dispatch(self, conn, req):
+        if not isinstance(req, (tuple, list)):
+            await self._send_error(conn, "Invalid protocol", -1, None)
+            return
+
+        self._metrics['requests'] += 1
+        try:
+            _logger.debug('parsing req: %s', req)
+            msg_id, method, args, method_name = self._parse_request(req)
+            _logger.debug('parsing completed: %s', req)
+        except Exception as e:
+            if isinstance(e, MethodNotFoundError) and req[2] == FD_CHANNEL_METHOD:
+                await self._open_fd_channel(conn, req[1], req[3])
+                return
+            _logger.error("Exception %s raised when _parse_request %s", e, req)
+            self._metrics['errors'] += 1
+            if isinstance(e, MethodNotFoundError):
+                await self._send_error(conn, type(e).__name__, str(e), req[1])
+            return
+
+        if self._batchers:
+            batcher = self._batchers.get(method_name)
+            if batcher is not None:
+                self._submit_batched(conn, batcher, msg_id, method_name, args)
+                return
+
+        if self._peer_methods and method_name in self._peer_methods:
+            if conn.remote is None:
+                conn.remote = Peer(conn, self._timeout, self._pack_params)
+            # the connection keeps reading, responses of the peer are awaited
+            conn.pending += 1
+            asyncio.ensure_future(self._execute_with_peer(conn, msg_id, method, method_name, args))
+            return
+
+        await self._execute(conn, msg_id, method, method_name, args)
+
+    async def _execute_with_peer(self, conn, msg_id, method, method_name, args):
+        try:
+            await self._execute(conn, msg_id, method, method_name, (conn.remote,) + tuple(args))
+        finally:
+            conn.pending -= 1
+            conn.last_activity = time.monotonic()
+
+    async def _execute(self, conn, msg_id, method, method_name, args):
+        req_start = datetime.datetime.now()
+        # Execute the parsed request
+        record = self._diagnostics.begin(method_name) if self._diagnostics is not None else None
+        try:
+            _logger.debug('calling method: %s', method)
+            ret = await self._invoke(method, args, record)
+            _logger.debug('calling %s completed. result: %s', method, ret)
+        except Exception as e:
+            if record is not None:
+                self._diagnostics.end(record)
+            _logger.error("Caught Exception in `%s`. %s: %s", method_name, type(e).__name__, e)
+            self._metrics['errors'] += 1
+            await self._send_error(conn, type(e).__name__, str(e), msg_id)
+            _logger.debug('sending exception %e completed', e)
+        else:
+            if record is not None:
+                self._diagnostics.end(record)
+            _logger.debug('sending result: %s', ret)
+            await self._send_result(conn, ret, msg_id)
+            _logger.debug('sending result %s completed', ret)
+
+        req_end = datetime.datetime.now()
+        _logger.info("Method `%s` took %fms", method_name, (req_end - req_start).microseconds / 1000)
+
+    async def call_local(self, method_name, args):
+        """Dispatch a call from the same process, skipping sockets and msgpack.
+        Errors are raised the way RPCClient raises remote errors. Used by
+        RPCClient(local=server).
+
+        :param str method_name: Method name.
+        :param tuple args: Method arguments.
+        :raises EnhancedRPCError: when the method is missing or raised.
+        """
+        self._metrics['requests'] += 1
+        try:
+            method = self._lookup(method_name)
+            batcher = self._batchers.get(method_name) if self._batchers else None
+            if batcher is not None:
+                return await batcher.submit(args)
+            if self._peer_methods and method_name in self._peer_methods:
+                # no connection, hence no peer to call back
+                args = (None,) + tuple(args)
+            return await self._invoke(method, args)
+        except Exception as e:
+            _logger.error("Caught Exception in `%s`. %s: %s", method_name, type(e).__name__, e)
+            self._metrics['errors'] += 1
+            raise EnhancedRPCError(type(e).__name__, str(e))
+
+    async def _invoke(self, method, args, record=None):
+        if self._executor is not None and not asyncio.iscoroutinefunction(method):
+            ret = asyncio.get_event_loop().run_in_executor(
+                self._executor, functools.partial(method, *args))
+        else:
+            ret = method.__call__(*args)
+        if record is not None and asyncio.iscoroutine(ret):
+            record.coro = ret
+        if asyncio.iscoroutine(ret) or asyncio.isfuture(ret):
+            _logger.debug("start to wait_for")
+            ret = await asyncio.wait_for(ret, self._timeout)
+        return ret
+
+    def _submit_batched(self, conn, batcher, msg_id, method_name, args):
+        # the connection keeps reading while the batch fills up, so pipelined
+        # calls of one client can share a batch as well
+        conn.pending += 1
+
+        def _done(future):
+            conn.pending -= 1
+            asyncio.ensure_future(self._send_outcome(conn, future, msg_id, method_name))
+
+        batcher.submit(args).add_done_callback(_done)
+
+    async def _send_outcome(self, conn, future, msg_id, method_name):
+        e = future.exception()
+        if e is not None:
+            _logger.error("Caught Exception in `%s`. %s: %s", method_name, type(e).__name__, e)
+            self._metrics['errors'] += 1
+            await self._send_error(conn, type(e).__name__, str(e), msg_id)
+        else:
+            await self._send_result(conn, future.result(), msg_id)
+
+    async def serve(self, reader, writer):
+        """Serve function.
+        Don't use this outside asyncio.start_server.
+        """
+        _logger.debug('enter serve: %s', writer.get_extra_info('peername'))
+        if self._draining:
+            writer.close()
+            return
+
+        conn = Connection(reader, writer,
+                          msgpack.Unpacker(max_buffer_size=self._max_buffer_size,
+                                           **self._unpack_params),
+                          self._max_buffer_size, self._max_message_size)
+        self._metrics['connections'] += 1
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self._metrics['tls_handshakes'] += 1
+            if ssl_object.session_reused:
+                self._metrics['tls_resumed'] += 1
+        self._connections.add(conn)
+        if self._diagnostics is not None:
+            self._diagnostics.start()
+        capture_id = None
+        if self._capture is not None:
+            capture_id = self._capture.sample_connection()
+            if capture_id is not None:
+                conn.keep_raw()
+        if self._sweeper is None and self._get_idle_timeout():
+            self._sweeper = asyncio.ensure_future(self._sweep_idle_connections())
+        try:
+            while not conn.is_closed():
+                try:
+                    req = await conn.recv()
+                except RPCProtocolError as e:
+                    _logger.warning("Closing connection to %s: %s", conn.peer, e)
+                    await self._send_error(conn, type(e).__name__, str(e), None)
+                    conn.close()
+                    break
+                except IOError as ie:
+                    break
+                except Exception as e:
+                    conn.reader.set_exception(e)
+                    raise e
+
+                if capture_id is not None:
+                    self._capture.write(capture_id, conn.last_raw)
+
+                if conn.remote is not None and isinstance(req, (tuple, list)) and len(req) == 4 \
+                        and req[0] == MSGPACKRPC_RESPONSE:
+                    conn.remote._on_response(req)
+                    continue
+
+                if self._scheduler is not None:
+                    await self._schedule(conn, req)
+                    continue
+
+                conn.pending += 1
+                try:
+                    await self._dispatch(conn, req)
+                finally:
+                    conn.pending -= 1
+                    conn.last_activity = time.monotonic()
+        finally:
+            self._connections.discard(conn)
+            if conn.remote is not None:
+                # Peer handles kept by the application must see the connection gone
+                conn.close()
+                conn.remote._fail_pending(ConnectionLostError('Connection to {} lost'.format(conn.peer)))
+            if conn.fd_channel is not None:
+                conn.fd_channel.close()
+            if self._scheduler is not None:
+                self._scheduler.discard(conn)
+
+    async def _schedule(self, conn, req):
+        valid = isinstance(req, (tuple, list)) and len(req) == 4 and isinstance(req[2], str)
+        lane = self._scheduler.lane_of(req[2], req[3]) if valid \
+            else self._scheduler.lane_of(None, None)
+
+        async def _job():
+            try:
+                await self._dispatch(conn, req)
+            finally:
+                conn.pending -= 1
+                conn.last_activity = time.monotonic()
+
+        conn.pending += 1
+        try:
+            self._scheduler.submit(lane, conn, _job)
+        except LaneFullError as e:
+            conn.pending -= 1
+            _logger.warning("Rejecting request from %s: %s", conn.peer, e)
+            self._metrics['errors'] += 1
+            await self._send_error(conn, type(e).__name__, str(e), req[1] if valid else None)
+
+
+# The module level API below drives a default server shared by every caller
+# of the functions, it predates RPCServer and is kept for compatibility.
+_default_server = RPCServer()
+
+
+def register(name, f, batch=None, peer=False):
+    """Register a function on the default RPC server.
     Usage:
         >>> def sum(x, y):
         >>>     return x + y
@@ -27,31 +751,24 @@ def register(name, f):
 
     :param name: The remote name of the function, can be different with the f.__name__.
     :param f: Function object. Must be a callable object or a coroutine object.
+    :param batch: (optional) BatchPolicy, see RPCServer.register.
+    :param peer: (optional) Pass f a Peer handle, see RPCServer.register.
     :return: None
     """
-    global _methods
-    if not hasattr(f, "__call__"):
-        raise MethodRegisteredError("{} is not a callable object".format(f.__name__))
-    if name in _methods:
-        raise MethodRegisteredError("Name {} has already been used".format(name))
-    _methods[name] = f
+    _default_server.register(name, f, batch, peer)
 
 
 def register_class(cls):
     """
-    Registers a class on the RPC server. Methods can be accessed by ClassName.Method
+    Registers a class on the default RPC server. Methods can be accessed by ClassName.Method
     :param cls: class to load
     :return:
     """
-    name = cls.__name__
-    _logger.info("Loaded class `%s`", name)
-    if name in _class_methods:
-        raise MethodRegisteredError("Class {} has already been loaded".format(name))
-    _class_methods[name] = cls()
+    _default_server.register_class(cls)
 
 
 def msgpack_init(**kwargs):
-    """Init parameters of msgpack packer and unpacker.
+    """Init parameters of msgpack packer and unpacker of the default RPC server.
     Usage:
         >>> msgpack_init(unicode_errors='backslashreplace')
     :param kwargs: See https://msgpack-python.readthedocs.io/en/latest/api.html
@@ -60,138 +777,30 @@ def msgpack_init(**kwargs):
             unpack_params=dict(use_list=False)
     :return: None
     """
-    global _pack_params, _unpack_params
-    _pack_params = kwargs.pop('pack_params', dict())
-    _unpack_params = kwargs.pop('unpack_params', dict(use_list=False))
+    _default_server.msgpack_init(**kwargs)
 
 
-def set_timeout(timeout):
-    """Set the IO timeout
+def set_timeout(timeout, idle_timeout=None):
+    """Set the IO timeout of the default RPC server.
     Usage:
         >>> set_timeout(1)
 
-    :param timeout: Timeout. Seconds.
+    :param timeout: Request timeout. Seconds.
+    :param idle_timeout: Idle connection timeout. Seconds. Defaults to timeout.
     :return: None
     """
-    global _timeout
-    _timeout = timeout
-
-
-async def _send_error(conn, exception, error, msg_id):
-    response = (MSGPACKRPC_RESPONSE, msg_id, (exception, error), None)
-    try:
-        await conn.sendall(msgpack.packb(response, use_bin_type=False, **_pack_params),
-                           _timeout)
-    except asyncio.TimeoutError as te:
-        _logger.error("Timeout when _send_error %s to %s",
-            error, conn.writer.get_extra_info('peername')
-        )
-    except Exception as e:
-        _logger.error("Exception %s raised when _send_error %s to %s",
-            e, error, conn.writer.get_extra_info("peername")
-        )
-
-
-async def _send_result(conn, result, msg_id):
-    _logger.debug('entering _send_result')
-    response = (MSGPACKRPC_RESPONSE, msg_id, None, result)
-    try:
-        _logger.debug('begin to sendall')
-        ret = msgpack.packb(response, use_bin_type=False, **_pack_params)
-        await conn.sendall(ret, _timeout)
-        _logger.debug('sendall completed')
-    except asyncio.TimeoutError as te:
-        _logger.error("Timeout when _send_result %s to %s",
-            result, conn.writer.get_extra_info('peername'))
-    except Exception as e:
-        _logger.error("Exception %s raised when _send_result %s to %s",
-            e, result, conn.writer.get_extra_info("peername")
-        )
-
-
-def _parse_request(req):
-    if len(req) != 4 or req[0] != MSGPACKRPC_REQUEST:
-        raise RPCProtocolError('Invalid protocol')
-
-    _, msg_id, method_name, args = req
-
-    _method_soup = method_name.split('.')
-    if len(_method_soup) == 1:
-        method = _methods.get(method_name)
-    else:
-        method = getattr(_class_methods.get(_method_soup[0]), _method_soup[1])
-
-    if not method:
-        raise MethodNotFoundError("No such method {}".format(method_name))
-
-    return msg_id, method, args, method_name
+    _default_server.set_timeout(timeout, idle_timeout)
 
 
-async def serve(reader, writer):
-    """Serve function.
-    Don't use this outside asyncio.start_server.
+def set_limits(max_buffer_size=None, max_message_size=None):
+    """Set the per-connection memory limits of the default RPC server.
+    See RPCServer.set_limits.
     """
-    global _unpack_params
-    _logger.debug('enter serve: %s', writer.get_extra_info('peername'))
-
-    conn = Connection(reader, writer,
-                      msgpack.Unpacker(**_unpack_params))
+    _default_server.set_limits(max_buffer_size, max_message_size)
 
-    while not conn.is_closed():
-        reqs = []
-        try:
-            reqs = await conn.recvall(_timeout)
-        except asyncio.TimeoutError as te:
-            await asyncio.sleep(3)
-            _logger.warning("Client did not send any data before timeout. Closing connection...")
-            conn.close()
-            continue
-        except IOError as ie:
-            break
-        except Exception as e:
-            conn.reader.set_exception(e)
-            raise e
 
-        for req in reqs:
-            if not isinstance(req, (tuple, list)):
-                try:
-                    await _send_error(conn, "Invalid protocol", -1, None)
-                    # skip the rest of iteration code after sending error
-                    continue
-
-                except Exception as e:
-                    _logger.error("Error when receiving req: %s", e)
-
-            req_start = datetime.datetime.now()
-            method = None
-            msg_id = None
-            args = None
-            try:
-                _logger.debug('parsing req: %s', req)
-                msg_id, method, args, method_name = _parse_request(req)
-                _logger.debug('parsing completed: %s', req)
-            except Exception as e:
-                _logger.error("Exception %s raised when _parse_request %s", e, req)
-
-                # skip the rest of iteration code since we already got an error
-                continue
-
-            # Execute the parsed request
-            try:
-                _logger.debug('calling method: %s', method)
-                ret = method.__call__(*args)
-                if asyncio.iscoroutine(ret):
-                    _logger.debug("start to wait_for")
-                    ret = await asyncio.wait_for(ret, _timeout)
-                _logger.debug('calling %s completed. result: %s', method, ret)
-            except Exception as e:
-                _logger.error("Caught Exception in `%s`. %s: %s", method_name, type(e).__name__, e)
-                await _send_error(conn, type(e).__name__, str(e), msg_id)
-                _logger.debug('sending exception %e completed', e)
-            else:
-                _logger.debug('sending result: %s', ret)
-                await _send_result(conn, ret, msg_id)
-                _logger.debug('sending result %s completed', ret)
-
-            req_end = datetime.datetime.now()
-            _logger.info("Method `%s` took %fms", method_name, (req_end - req_start).microseconds / 1000)
+async def serve(reader, writer):
+    """Serve function of the default RPC server.
+    Don't use this outside asyncio.start_server.
+    """
+    await _default_server.serve(reader, writer)
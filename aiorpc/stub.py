@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import inspect
+import sys
+
+__all__ = ['Stub']
+
+
+def _signature(cls, attr):
+    """Signature of a method as called over RPC, without self or cls.
+    None when it can't be inspected, the arguments are then not checked."""
+    try:
+        signature = inspect.signature(getattr(cls, attr))
+    except (TypeError, ValueError):
+        return None
+    if isinstance(inspect.getattr_static(cls, attr), (staticmethod, classmethod)):
+        return signature
+    params = list(signature.parameters.values())[1:]
+    return signature.replace(parameters=params)
+
+
+def _arity(signature):
+    min_args, max_args = 0, 0
+    for param in signature.parameters.values():
+        if param.kind == param.VAR_POSITIONAL:
+            return min_args, sys.maxsize
+        if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+            max_args += 1
+            if param.default is param.empty:
+                min_args += 1
+    return min_args, max_args
+
+
+class _StubMethod:
+    __slots__ = ('_client', '_name', '_encoded', '_signature', '_min_args', '_max_args')
+
+    def __init__(self, client, name, signature):
+        self._client = client
+        self._name = name
+        self._encoded = client._encode_method(name)
+        self._signature = signature
+        self._min_args, self._max_args = (0, sys.maxsize) if signature is None else _arity(signature)
+
+    def __call__(self, *args, **kwargs):
+        # checked before the coroutine exists, a wrong call raises right away
+        if kwargs or not self._min_args <= len(args) <= self._max_args:
+            args = self._bind(args, kwargs)
+        return self._client._call_stub(self._name, self._encoded, args)
+
+    def _bind(self, args, kwargs):
+        if self._signature is None:
+            raise TypeError("{}() gets positional arguments only".format(self._name))
+        try:
+            bound = self._signature.bind(*args, **kwargs)
+        except TypeError as e:
+            raise TypeError("{}(): {}".format(self._name, e)) from None
+        if bound.kwargs:
+            raise TypeError("{}(): keyword only arguments can't be sent: {}".format(
+                self._name, ', '.join(bound.kwargs)))
+        return bound.args
+
+    def __repr__(self):
+        return '<stub method {}{}>'.format(self._name, self._signature or '(...)')
+
+
+class Stub:
+    """Proxy calling the methods of a class registered on the server.
+    Usage:
+        >>> stub = client.stub(Calculator)
+        >>> await stub.add(1, 2)
+
+    The method names are encoded once when the stub is built, every call only
+    packs its msg_id and arguments. Arguments are checked against the method
+    signatures, so a wrong call raises TypeError without reaching the server.
+    Keyword arguments are turned into positional ones.
+
+    :param client: RPCClient sending the calls.
+    :param cls: Class registered on the server with register_class.
+    :param str name: (optional) Name the class is registered under. Defaults
+        to the class name.
+    """
+
+    def __init__(self, client, cls, name=None):
+        self._service = name or cls.__name__
+        for attr in dir(cls):
+            if not attr.startswith('_') and callable(getattr(cls, attr)):
+                setattr(self, attr, _StubMethod(client, '{}.{}'.format(self._service, attr),
+                                                _signature(cls, attr)))
+
+    def __repr__(self):
+        return '<Stub {}>'.format(self._service)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+import threading
+
+from aiorpc.client import RPCClient
+from aiorpc.log import rootLogger
+
+__all__ = ['SyncRPCClient']
+
+_logger = rootLogger.getChild(__name__)
+
+
+class SyncRPCClient:
+    """Blocking RPC client, safe to share between threads.
+    A background thread runs the event loop and a small pool of connections,
+    so any number of threads share `pool_size` sockets.
+
+    Usage:
+        >>> from aiorpc.sync_client import SyncRPCClient
+        >>> with SyncRPCClient('127.0.0.1', 6000) as client:
+        >>>     client.call('sum', 1, 2)
+        >>>     future = client.submit('sum', 3, 4)
+        >>>     future.result()
+
+    :param str host: Hostname.
+    :param int port: Port number.
+    :param str path: Unix socket path. Either this one or host and port are required.
+    :param int pool_size: Number of connections shared by all threads.
+    :param client_params: Passed to every RPCClient.
+    """
+
+    def __init__(self, host=None, port=None, path=None, pool_size=2, **client_params):
+        self._clients = [RPCClient(host, port, path, **client_params) for _ in range(pool_size)]
+        self._next = 0
+        self._queue = []
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._closed = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='aiorpc-sync-client', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            for client in self._clients:
+                client.close()
+            # in-flight calls fail with the closed connections, wait for them
+            # so that no task is left pending on a closed loop
+            pending = asyncio.all_tasks(self._loop)
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self._loop.close()
+
+    def submit(self, method, *args):
+        """Calls a RPC method without blocking. Safe from any thread.
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :return: concurrent.futures.Future of the result.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('SyncRPCClient is closed')
+            self._queue.append((method, args, future))
+            if self._scheduled:
+                return future
+            self._scheduled = True
+        # a single wakeup of the loop serves every submission queued meanwhile
+        self._loop.call_soon_threadsafe(self._drain)
+        return future
+
+    def call(self, method, *args, timeout=None):
+        """Calls a RPC method and blocks until the result is there.
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param timeout: (optional) Seconds to wait for the result.
+        """
+        return self.submit(method, *args).result(timeout)
+
+    def _drain(self):
+        with self._lock:
+            queue, self._queue = self._queue, []
+            self._scheduled = False
+        for method, args, future in queue:
+            if not future.set_running_or_notify_cancel():
+                continue
+            client = self._clients[self._next]
+            self._next = (self._next + 1) % len(self._clients)
+            task = asyncio.ensure_future(client.call(method, *args))
+            task.add_done_callback(lambda t, f=future: self._settle(t, f))
+
+    @staticmethod
+    def _settle(task, future):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def close(self):
+        """Close the connections and stop the background thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import math
+import weakref
+
+__all__ = ['TimerWheel', 'get_timer_wheel']
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+class TimerWheel:
+    """Hashed timer wheel.
+    Expiring many timeouts costs a single loop timer per tick instead of one
+    timer handle per timeout. Timeouts are rounded up to the resolution.
+
+    Entries must provide ``expire()``, called once their deadline passed.
+    Cancelling is lazy: entries that finished early simply ignore ``expire()``.
+
+    :param loop: Event loop driving the wheel.
+    :param float resolution: Tick length in seconds.
+    :param int slots: Number of buckets, a timeout longer than
+        ``resolution * slots`` goes around the wheel more than once.
+    """
+
+    def __init__(self, loop, resolution=0.01, slots=1024):
+        self._loop = loop
+        self._resolution = resolution
+        self._slots = slots
+        self._buckets = [[] for _ in range(slots)]
+        self._count = 0
+        self._tick = self._now_tick()
+        self._handle = None
+
+    def __len__(self):
+        return self._count
+
+    def _now_tick(self):
+        return int(self._loop.time() / self._resolution)
+
+    def schedule(self, delay, entry):
+        """Call ``entry.expire()`` after `delay` seconds."""
+        if self._handle is None:
+            # the wheel stood still, catch up with the clock
+            self._tick = self._now_tick()
+        expires = max(self._tick + 1, math.ceil((self._loop.time() + delay) / self._resolution))
+        self._buckets[expires % self._slots].append((expires, entry))
+        self._count += 1
+        if self._handle is None:
+            self._handle = self._loop.call_later(self._resolution, self._advance)
+
+    def _advance(self):
+        now = self._now_tick()
+        while self._tick < now and self._count:
+            self._tick += 1
+            index = self._tick % self._slots
+            bucket = self._buckets[index]
+            if not bucket:
+                continue
+            kept = []
+            for expires, entry in bucket:
+                if expires <= self._tick:
+                    self._count -= 1
+                    entry.expire()
+                else:
+                    kept.append((expires, entry))
+            self._buckets[index] = kept
+        self._tick = now
+        if self._count:
+            self._handle = self._loop.call_later(self._resolution, self._advance)
+        else:
+            self._handle = None
+
+
+def get_timer_wheel(loop=None):
+    """Return the TimerWheel shared by everything running on `loop`."""
+    loop = loop or asyncio.get_event_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel(loop)
+    return wheel
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import weakref
+
+__all__ = []
+
+# SSLContext -> endpoint -> last ssl.SSLSession, shared by the clients of a context
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_session(context, endpoint):
+    return _sessions.get(context, {}).get(endpoint)
+
+
+def remember_session(context, endpoint, ssl_object):
+    """Keep the session of `ssl_object` for the next connection to `endpoint`.
+    TLS 1.3 sends session tickets after the handshake, so this is called once
+    data went through the connection."""
+    session = ssl_object.session
+    if session is not None and session.has_ticket:
+        _sessions.setdefault(context, {})[endpoint] = session
+
+
+class ResumingContext:
+    """SSLContext wrapper resuming `session` on the connection it sets up.
+    Everything but wrap_bio is delegated to the wrapped context."""
+
+    def __init__(self, context, session):
+        self._context = context
+        self._session = session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return self._context.wrap_bio(incoming, outgoing, server_side=server_side,
+                                      server_hostname=server_hostname,
+                                      session=session or self._session)
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
@@ -3,10 +3,18 @@
 
 import asyncio
 
+import msgpack
 from nose.tools import *
 
-from aiorpc import RPCClient, register, serve, register_class
-from aiorpc.exceptions import RPCError, EnhancedRPCError
+from aiorpc import RPCClient, SyncRPCClient, RPCServer, RPCProxy, Diagnostics, TrafficCapture, FileRegion, RetryPolicy, HedgePolicy, BatchPolicy, RoutingClient, HashRing, \
+    Lane, Scheduler, \
+    register, serve, register_class, set_limits
+from aiorpc.capture import read_capture
+from aiorpc.replay import replay
+from aiorpc.router import endpoints_from_file
+from aiorpc.timer import TimerWheel
+from aiorpc.connection import Connection
+from aiorpc.exceptions import RPCError, EnhancedRPCError, MessageTooLargeError, ConnectionLostError
 
 HOST = 'localhost'
 PORT = 6000
@@ -49,6 +57,17 @@ def raise_error():
     raise Exception('error msg')
 
 
+_slow_first_calls = 0
+
+
+async def slow_first(msg):
+    global _slow_first_calls
+    _slow_first_calls += 1
+    if _slow_first_calls == 1:
+        await asyncio.sleep(2)
+    return msg
+
+
 def set_up_inet_server():
     global loop, inet_server
     if not loop:
@@ -69,6 +88,7 @@ def register_handlers():
     register('echo', echo)
     register('echo_delayed', echo_delayed)
     register('raise_error', raise_error)
+    register('slow_first', slow_first)
     register_class(my_class)
 
 
@@ -217,4 +237,1059 @@ def test_unix_class_call():
         eq_('message', ret)
         client.close()
 
-    loop.run_until_complete(_test_class_call())
\ No newline at end of file
+    loop.run_until_complete(_test_class_call())
+
+
+# Test message limits
+class _fake_writer:
+    def get_extra_info(self, name):
+        return ('fake', 0)
+
+
+def _fed_connection(data, **limits):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    unpacker = msgpack.Unpacker(max_buffer_size=limits.get('max_buffer_size', 0))
+    return Connection(reader, _fake_writer(), unpacker, **limits)
+
+
+def test_connection_recv_one_message_at_a_time():
+    async def _test_recv():
+        conn = _fed_connection(b''.join(msgpack.packb(i) for i in range(3)))
+        eq_(0, await conn.recv(1))
+        eq_(1, await conn.recv(1))
+        eq_(2, await conn.recv(1))
+        eq_(0, conn.buffered())
+
+    loop.run_until_complete(_test_recv())
+
+
+@raises(MessageTooLargeError)
+def test_connection_max_message_size():
+    async def _test_recv():
+        conn = _fed_connection(msgpack.packb('x' * 100), max_message_size=50)
+        await conn.recv(1)
+
+    loop.run_until_complete(_test_recv())
+
+
+@raises(MessageTooLargeError)
+def test_connection_max_buffer_size():
+    async def _test_recv():
+        conn = _fed_connection(msgpack.packb(b'x' * 100), max_buffer_size=64)
+        await conn.recv(1)
+
+    loop.run_until_complete(_test_recv())
+
+
+def test_server_max_message_size():
+    async def _test_call():
+        client = RPCClient(HOST, PORT)
+        try:
+            await client.call('echo', 'x' * 4096)
+        except EnhancedRPCError as e:
+            eq_('MessageTooLargeError', e.parent)
+        else:
+            ok_(False, 'server accepted an oversized request')
+        finally:
+            client.close()
+
+    set_limits(max_message_size=1024)
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        set_limits()
+
+
+@raises(MessageTooLargeError)
+def test_client_max_message_size():
+    async def _test_call():
+        client = RPCClient(HOST, PORT, max_message_size=1024)
+        try:
+            await client.call('echo', 'x' * 4096)
+        finally:
+            client.close()
+
+    loop.run_until_complete(_test_call())
+
+
+# Test failure handling
+def _start_flaky_server(port, drops):
+    """Start a server on `port` which drops its first `drops` connections."""
+    accepted = []
+
+    async def _serve(reader, writer):
+        accepted.append(writer)
+        if len(accepted) <= drops:
+            await reader.read(1)
+            writer.close()
+            return
+        await serve(reader, writer)
+
+    server = loop.run_until_complete(asyncio.start_server(_serve, HOST, port))
+    return server, accepted
+
+
+@raises(ConnectionLostError)
+def test_pending_calls_fail_on_disconnect():
+    server, _ = _start_flaky_server(PORT + 1, drops=1)
+
+    async def _test_call():
+        client = RPCClient(HOST, PORT + 1)
+        try:
+            await asyncio.wait_for(client.call('echo', 'message'), 1)
+        finally:
+            client.close()
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        server.close()
+
+
+def test_retry_idempotent_method():
+    server, accepted = _start_flaky_server(PORT + 1, drops=2)
+
+    async def _test_call():
+        client = RPCClient(HOST, PORT + 1, retry_policies={'echo': RetryPolicy(attempts=3, backoff=0.01)})
+        ret = await asyncio.wait_for(client.call('echo', 'message'), 2)
+        eq_('message', ret)
+        eq_(3, len(accepted))
+        client.close()
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        server.close()
+
+
+def test_reconnect_with_backoff():
+    server = None
+
+    async def _start_later():
+        nonlocal server
+        await asyncio.sleep(0.1)
+        server = await asyncio.start_server(serve, HOST, PORT + 1)
+
+    async def _test_call():
+        client = RPCClient(HOST, PORT + 1, connect_attempts=10, reconnect_backoff=0.05)
+        starter = asyncio.ensure_future(_start_later())
+        ret = await asyncio.wait_for(client.call('echo', 'message'), 5)
+        eq_('message', ret)
+        await starter
+        client.close()
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        server.close()
+
+
+def test_hedged_call():
+    async def _test_call():
+        client = RPCClient(HOST, PORT, hedge_policies={'slow_first': HedgePolicy(delay=0.05)})
+        start = loop.time()
+        ret = await client.call('slow_first', 'message')
+        eq_('message', ret)
+        ok_(loop.time() - start < 1)
+        client.close()
+
+    loop.run_until_complete(_test_call())
+
+
+# Test routing
+def test_hash_ring_minimal_remap():
+    keys = ['key{}'.format(i) for i in range(2000)]
+    ring = HashRing(['node{}'.format(i) for i in range(10)])
+    before = {k: ring.get(k) for k in keys}
+
+    ring.add('node10')
+    after = {k: ring.get(k) for k in keys}
+    moved = [k for k in keys if before[k] != after[k]]
+    ok_(all(after[k] == 'node10' for k in moved))
+    ok_(0 < len(moved) < len(keys) * 2 / 11)
+
+    ring.remove('node10')
+    eq_(before, {k: ring.get(k) for k in keys})
+
+    ring.remove('node3')
+    moved = [k for k in keys if before[k] != ring.get(k)]
+    ok_(all(before[k] == 'node3' for k in moved))
+
+
+def test_routing_client_hash_key():
+    async def _test_call():
+        async with RoutingClient([(HOST, PORT), PATH], key=0) as client:
+            for i in range(10):
+                key = 'key{}'.format(i)
+                eq_(key, await client.call('echo', key))
+                eq_(client.route('echo', (key,)), client._ring.get(key))
+
+    loop.run_until_complete(_test_call())
+
+
+def test_routing_client_least_loaded():
+    async def _test_call():
+        async with RoutingClient([(HOST, PORT), PATH]) as client:
+            slow = asyncio.ensure_future(client.call('echo_delayed', 'message', 0.2))
+            await asyncio.sleep(0.05)
+            busy = [e for e in client.endpoints() if client._nodes[e].inflight]
+            eq_(1, len(busy))
+            ok_(client.route('echo', ()) != busy[0])
+            eq_('message', await slow)
+
+    loop.run_until_complete(_test_call())
+
+
+def test_routing_client_file_refresh():
+    import tempfile
+
+    async def _test_call():
+        with tempfile.NamedTemporaryFile('w', suffix='.nodes') as f:
+            f.write('{}:{}\n'.format(HOST, PORT))
+            f.flush()
+            client = RoutingClient(refresher=endpoints_from_file(f.name), key=0)
+            eq_('message', await client.call('echo', 'message'))
+            eq_([(HOST, PORT)], client.endpoints())
+            client.close()
+
+    loop.run_until_complete(_test_call())
+
+
+# Test RPCServer instances
+def test_server_instances_are_isolated():
+    fast, bulk = RPCServer(timeout=0.5), RPCServer(timeout=3)
+    fast.register('echo_delayed', echo_delayed)
+    bulk.register('echo_delayed', echo_delayed)
+    bulk.register('echo', echo)
+    fast_server = loop.run_until_complete(asyncio.start_server(fast.serve, HOST, PORT + 2))
+    bulk_server = loop.run_until_complete(asyncio.start_server(bulk.serve, HOST, PORT + 3))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as fast_client, RPCClient(HOST, PORT + 3) as bulk_client:
+            try:
+                await fast_client.call('echo_delayed', 'message', 1)
+            except EnhancedRPCError as e:
+                eq_('TimeoutError', e.parent)
+            else:
+                ok_(False, 'fast server did not time out')
+
+            try:
+                await fast_client.call('echo', 'message')
+            except EnhancedRPCError as e:
+                eq_('MethodNotFoundError', e.parent)
+            else:
+                ok_(False, 'fast server found a method registered on bulk server')
+
+            eq_('message', await bulk_client.call('echo_delayed', 'message', 1))
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        fast_server.close()
+        bulk_server.close()
+    eq_(2, fast.get_metrics()['requests'])
+    eq_(1, bulk.get_metrics()['requests'])
+
+
+def test_server_executor():
+    import concurrent.futures
+    import threading
+
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    server = RPCServer(executor=executor)
+    server.register('thread_name', lambda: threading.current_thread().name)
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            ok_(await client.call('thread_name') != threading.current_thread().name)
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()
+        executor.shutdown()
+
+
+# Test idle connections
+def test_idle_connections_are_swept():
+    server = RPCServer(timeout=3, idle_timeout=0.2)
+    server.register('echo', echo)
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_idle():
+        idle, busy = RPCClient(HOST, PORT + 2), RPCClient(HOST, PORT + 2)
+        eq_('message', await idle.call('echo', 'message'))
+        eq_('message', await busy.call('echo', 'message'))
+        metrics = server.get_metrics()
+        eq_(2, metrics['active_connections'])
+        eq_(2, metrics['idle_connections'])
+
+        for _ in range(6):
+            await asyncio.sleep(0.1)
+            eq_('message', await busy.call('echo', 'message'))
+        ok_(idle._conn.is_closed())
+        ok_(not busy._conn.is_closed())
+        metrics = server.get_metrics()
+        eq_(1, metrics['active_connections'])
+        eq_(1, metrics['idle_closed'])
+        idle.close()
+        busy.close()
+
+    try:
+        loop.run_until_complete(_test_idle())
+    finally:
+        tcp_server.close()
+
+
+# Test batching
+def test_batched_calls():
+    batches = []
+
+    def double(batch):
+        batches.append(len(batch))
+        return [ValueError('negative') if x < 0 else x * 2 for x, in batch]
+
+    server = RPCServer()
+    server.register('double', double, batch=BatchPolicy(max_size=8, max_wait_ms=50))
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        clients = [RPCClient(HOST, PORT + 2) for _ in range(4)]
+        calls = [clients[i % 4].call('double', i) for i in range(12)]
+        eq_([i * 2 for i in range(12)], await asyncio.gather(*calls))
+        eq_([8, 4], batches)
+
+        try:
+            await clients[0].call('double', -1)
+        except EnhancedRPCError as e:
+            eq_('ValueError', e.parent)
+            eq_('negative', e.message)
+        else:
+            ok_(False, 'batched call did not fail')
+        for client in clients:
+            client.close()
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()
+
+
+# Test local transport
+def test_local_call():
+    server = RPCServer()
+    server.register('echo', echo)
+    server.register('raise_error', raise_error)
+    server.register_class(my_class)
+
+    async def _test_call():
+        async with RPCClient(local=server) as client:
+            eq_('message', await client.call('echo', 'message'))
+            eq_('message', await client.call('my_class.echo', 'message'))
+            try:
+                await client.call('raise_error')
+            except EnhancedRPCError as e:
+                eq_('Exception', e.parent)
+                eq_('error msg', e.message)
+            else:
+                ok_(False, 'local call did not raise')
+            try:
+                await client.call('missing')
+            except EnhancedRPCError as e:
+                eq_('MethodNotFoundError', e.parent)
+            else:
+                ok_(False, 'local call found a missing method')
+
+    loop.run_until_complete(_test_call())
+
+
+def test_local_call_copy_modes():
+    server = RPCServer()
+    server.register('echo', echo)
+
+    async def _test_call():
+        arg = {'key': [1, 2]}
+        direct = RPCClient(local=server, local_copy='none')
+        ok_(await direct.call('echo', arg) is arg)
+
+        copied = RPCClient(local=server, local_copy='copy')
+        ret = await copied.call('echo', arg)
+        eq_(arg, ret)
+        ok_(ret is not arg)
+
+        wire = RPCClient(local=server, local_copy='msgpack')
+        eq_({'key': (1, 2)}, await wire.call('echo', arg))
+
+    loop.run_until_complete(_test_call())
+
+
+# Test blocking client
+def test_sync_client_from_many_threads():
+    import concurrent.futures
+
+    def _work(client, i):
+        return client.call('echo', i, timeout=5)
+
+    def _test_call():
+        with SyncRPCClient(HOST, PORT, pool_size=2) as client:
+            with concurrent.futures.ThreadPoolExecutor(16) as pool:
+                eq_(list(range(100)), list(pool.map(lambda i: _work(client, i), range(100))))
+            eq_('message', client.submit('echo', 'message').result(5))
+            try:
+                client.call('raise_error', timeout=5)
+            except EnhancedRPCError as e:
+                eq_('Exception', e.parent)
+            else:
+                ok_(False, 'blocking call did not raise')
+            eq_(2, len([c for c in client._clients if c._conn is not None]))
+
+    # the test servers live on this loop, keep it running while threads block
+    loop.run_until_complete(loop.run_in_executor(None, _test_call))
+
+
+# Test pending calls
+def test_timer_wheel():
+    class _entry:
+        def __init__(self):
+            self.expired_at = None
+
+        def expire(self):
+            self.expired_at = loop.time()
+
+    async def _test_wheel():
+        wheel = TimerWheel(loop, resolution=0.01, slots=8)
+        start = loop.time()
+        short, long = _entry(), _entry()
+        wheel.schedule(0.05, short)
+        wheel.schedule(0.2, long)  # further than one turn of the wheel
+        eq_(2, len(wheel))
+        await asyncio.sleep(0.1)
+        ok_(short.expired_at is not None and short.expired_at - start >= 0.05)
+        ok_(long.expired_at is None)
+        await asyncio.sleep(0.2)
+        ok_(long.expired_at - start >= 0.2)
+        eq_(0, len(wheel))
+
+    loop.run_until_complete(_test_wheel())
+
+
+def test_call_timeout_is_per_call():
+    async def _test_call():
+        client = RPCClient(HOST, PORT, timeout=0.3)
+        slow = asyncio.ensure_future(client.call('echo_delayed', 'slow', 1))
+        await asyncio.sleep(0.05)
+        try:
+            await slow
+        except asyncio.TimeoutError:
+            pass
+        else:
+            ok_(False, 'slow call did not time out')
+        # the connection survives a timed out call
+        ok_(not client._conn.is_closed())
+        eq_(0, len(client._pending))
+        client.close()
+
+    loop.run_until_complete(_test_call())
+
+
+def test_msg_id_wraps_around():
+    async def _test_call():
+        client = RPCClient(HOST, PORT)
+        client._msg_id = 2 ** 32 - 2
+        eq_('a', await client.call('echo', 'a'))
+        eq_(2 ** 32 - 1, client._msg_id)
+        eq_('b', await client.call('echo', 'b'))
+        eq_(0, client._msg_id)
+        client.close()
+
+    loop.run_until_complete(_test_call())
+
+
+# Test scheduling
+def _start_scheduled_server(scheduler, port):
+    order = []
+
+    async def work(name, delay):
+        await asyncio.sleep(delay)
+        order.append(name)
+        return name
+
+    server = RPCServer(scheduler=scheduler)
+    server.register('work', work)
+    server.register('health', lambda: order.append('health') or 'ok')
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, port))
+    return server, tcp_server, order
+
+
+def test_scheduler_control_lane_skips_bulk_queue():
+    scheduler = Scheduler([Lane('control', weight=4, concurrency=1), Lane('bulk', concurrency=1)],
+                          methods={'health': 'control'}, default='bulk')
+    server, tcp_server, order = _start_scheduled_server(scheduler, PORT + 2)
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as bulk, RPCClient(HOST, PORT + 2) as control:
+            calls = [asyncio.ensure_future(bulk.call('work', i, 0.05)) for i in range(5)]
+            await asyncio.sleep(0.02)
+            eq_('ok', await control.call('health'))
+            ok_(order.index('health') <= 1)
+            await asyncio.gather(*calls)
+            lanes = server.get_metrics()['lanes']
+            eq_(5, lanes['bulk']['completed'])
+            eq_(1, lanes['control']['completed'])
+            ok_(lanes['bulk']['max_depth'] >= 3)
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()
+
+
+def test_scheduler_fair_between_connections():
+    scheduler = Scheduler([Lane('default', concurrency=1)])
+    server, tcp_server, order = _start_scheduled_server(scheduler, PORT + 2)
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as heavy, RPCClient(HOST, PORT + 2) as light:
+            calls = [asyncio.ensure_future(heavy.call('work', 'heavy', 0.05)) for _ in range(6)]
+            await asyncio.sleep(0.02)
+            eq_('light', await light.call('work', 'light', 0))
+            ok_(order.index('light') <= 2)
+            await asyncio.gather(*calls)
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()
+
+
+def test_scheduler_rejects_when_lane_is_full():
+    scheduler = Scheduler([Lane('default', concurrency=1, max_queue=1)])
+    server, tcp_server, order = _start_scheduled_server(scheduler, PORT + 2)
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            calls = [client.call('work', i, 0.05) for i in range(3)]
+            results = await asyncio.gather(*calls, return_exceptions=True)
+            eq_([0, 1], results[:2])
+            eq_('LaneFullError', results[2].parent)
+            eq_(1, server.get_metrics()['lanes']['default']['rejected'])
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()
+
+
+# Test diagnostics
+def test_diagnostics_slow_calls_and_loop_lag():
+    import time
+
+    async def slow_handler():
+        await asyncio.sleep(0.2)
+        return 'slow'
+
+    def blocking_handler():
+        time.sleep(0.3)
+        return 'blocking'
+
+    diagnostics = Diagnostics(slow_call_threshold=0.1, lag_threshold=0.1, lag_interval=0.05,
+                              profile=True)
+    server = RPCServer(diagnostics=diagnostics)
+    server.register('slow_handler', slow_handler)
+    server.register('blocking_handler', blocking_handler)
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            eq_('slow', await client.call('slow_handler'))
+            eq_('blocking', await client.call('blocking_handler'))
+            await asyncio.sleep(0.1)
+            eq_('slow', await client.call('slow_handler'))
+            report = await client.call('__diagnostics__')
+
+        calls = [r for r in report['records'] if r['kind'] == 'call']
+        eq_(['slow_handler', 'blocking_handler', 'slow_handler'], [r['method'] for r in calls])
+        ok_(any('slow_handler' in line for line in calls[0]['stack']))
+        ok_('profile' in calls[2])
+        blocked = [r for r in report['records'] if r['kind'] == 'loop_blocked']
+        ok_(any('blocking_handler' in line for r in blocked for line in r['stack']))
+        ok_(report['loop_lag']['max_ms'] >= 100)
+        ok_(report['loop_lag']['blocked'] >= 1)
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        diagnostics.stop()
+        tcp_server.close()
+
+
+# Test capture and replay
+def test_capture_and_replay():
+    import os
+    import tempfile
+
+    path = tempfile.mktemp(suffix='.capture')
+    capture = TrafficCapture(path)
+    server = RPCServer(capture=capture)
+    server.register('echo', echo)
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_capture():
+        async with RPCClient(HOST, PORT + 2) as first, RPCClient(HOST, PORT + 2) as second:
+            for i in range(5):
+                eq_(i, await first.call('echo', i))
+                eq_(str(i), await second.call('echo', str(i)))
+
+    async def _test_replay(records):
+        clients = [RPCClient(HOST, PORT) for _ in range(2)]
+        compare_clients = [RPCClient(path=PATH) for _ in range(2)]
+        report = await replay(records, clients, speed=0, compare_clients=compare_clients)
+        for client in clients + compare_clients:
+            client.close()
+        return report
+
+    try:
+        loop.run_until_complete(_test_capture())
+        capture.close()
+        records = list(read_capture(path))
+        eq_(10, len(records))
+        eq_(2, len(set(conn_id for _, conn_id, _ in records)))
+        eq_((0, 1, 'echo', (0,)), msgpack.unpackb(records[0][2], use_list=False))
+
+        report = loop.run_until_complete(_test_replay(records))
+        eq_(10, report['calls'])
+        eq_(0, report['errors'])
+        eq_(0, report['mismatches'])
+        ok_(report['latency_ms']['p99'] >= report['latency_ms']['p50'])
+    finally:
+        tcp_server.close()
+        os.remove(path)
+
+
+def test_capture_size_cap_and_sampling():
+    import os
+    import tempfile
+
+    path = tempfile.mktemp(suffix='.capture')
+    capture = TrafficCapture(path, max_bytes=100)
+    try:
+        while not capture.full():
+            capture.write(capture.sample_connection(), b'x' * 30)
+        eq_(None, capture.sample_connection())
+        capture.close()
+        ok_(os.path.getsize(path) < 150)
+        eq_(None, TrafficCapture(path, sample_rate=0).sample_connection())
+    finally:
+        os.remove(path)
+
+
+# Test RPCProxy
+def test_proxy_relays_raw_frames():
+    proxy = RPCProxy([(HOST, PORT), PATH], key=lambda method, args: args[0] if args else method)
+    proxy_server = loop.run_until_complete(asyncio.start_server(proxy.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        # both clients use the same msg_ids, the proxy keeps them apart
+        async with RPCClient(HOST, PORT + 2) as first, RPCClient(HOST, PORT + 2) as second:
+            calls = [client.call('echo_delayed', 'key{}'.format(i), 0.01 * (10 - i))
+                     for i in range(10) for client in (first, second)]
+            eq_(['key{}'.format(i) for i in range(10) for _ in range(2)], await asyncio.gather(*calls))
+            eq_('x' * 3000, await first.call('echo', 'x' * 3000))
+            try:
+                await first.call('raise_error')
+            except EnhancedRPCError as e:
+                eq_('Exception', e.parent)
+                eq_('error msg', e.message)
+            else:
+                ok_(False, 'error not relayed')
+        metrics = proxy.get_metrics()
+        eq_(22, metrics['requests'])
+        eq_(0, metrics['errors'])
+        eq_(2, sum(1 for inflight in metrics['inflight'].values() if inflight == 0))
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        proxy.close()
+        proxy_server.close()
+
+
+def test_proxy_backend_unavailable():
+    proxy = RPCProxy([(HOST, PORT + 9)], timeout=0.5)
+    proxy_server = loop.run_until_complete(asyncio.start_server(proxy.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            try:
+                await client.call('echo', 'message')
+            except EnhancedRPCError as e:
+                eq_('ConnectionRefusedError', e.parent)
+            else:
+                ok_(False, 'proxy reached a backend that does not exist')
+        eq_(1, proxy.get_metrics()['errors'])
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        proxy.close()
+        proxy_server.close()
+
+
+# Test interceptors
+def test_server_interceptors():
+    calls = []
+
+    async def trace(method_name, args, proceed):
+        calls.append(method_name)
+        return await proceed(*args)
+
+    async def check_token(method_name, args, proceed):
+        if args[0] != 'secret':
+            raise PermissionError('Invalid token')
+        return await proceed(*args[1:])
+
+    server = RPCServer(interceptors=[trace])
+    server.register('echo', echo)
+    server.add_interceptor(check_token, methods=lambda name: name.startswith('my_class.'))
+    # registered after the interceptors, composed on registration
+    server.register_class(my_class)
+    server.register('echo_delayed', echo_delayed)
+    eq_({'echo', 'echo_delayed', 'my_class.echo'}, set(server._chains))
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            eq_('message', await client.call('echo', 'message'))
+            eq_('message', await client.call('echo_delayed', 'message', 0))
+            eq_('message', await client.call('my_class.echo', 'secret', 'message'))
+            try:
+                await client.call('my_class.echo', 'guess', 'message')
+            except EnhancedRPCError as e:
+                eq_('PermissionError', e.parent)
+            else:
+                ok_(False, 'interceptor did not reject the call')
+
+    try:
+        loop.run_until_complete(_test_call())
+        eq_(['echo', 'echo_delayed', 'my_class.echo', 'my_class.echo'], calls)
+    finally:
+        tcp_server.close()
+
+
+def test_server_without_interceptors_dispatches_functions():
+    server = RPCServer()
+    server.register('echo', echo)
+    eq_({}, server._chains)
+    ok_(server._lookup('echo') is echo)
+
+    async def _noop(method_name, args, proceed):
+        return await proceed(*args)
+
+    server.add_interceptor(_noop, methods=['other'])
+    ok_(server._lookup('echo') is echo)
+
+
+def test_client_interceptors():
+    order = []
+
+    async def outer(method_name, args, proceed):
+        order.append('outer')
+        return await proceed(*args)
+
+    async def suffix(method_name, args, proceed):
+        order.append('suffix')
+        return (await proceed(*args)) + '!'
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT, interceptors=[outer]) as client:
+            client.add_interceptor(suffix, methods=['echo'])
+            eq_('message!', await client.call('echo', 'message'))
+            eq_('message', await client.call('echo_delayed', 'message', 0))
+            ok_(client._chains['echo'] is not client._chains['echo_delayed'])
+            eq_('message!', await client.call('echo', 'message'))
+
+    loop.run_until_complete(_test_call())
+    eq_(['outer', 'suffix', 'outer', 'outer', 'suffix'], order)
+
+
+# Test file results
+def test_file_region_sendfile():
+    import os
+    import tempfile
+
+    content = os.urandom(3 * 1024 ** 2)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(content)
+    server = RPCServer()
+    server.register('read_file', lambda offset, count: FileRegion(f.name, offset, count))
+    server.register('read_missing', lambda: FileRegion(f.name + '.missing'))
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            eq_(content, await client.call('read_file', 0, None))
+            eq_(content[1000:1100], await client.call('read_file', 1000, 100))
+            try:
+                await client.call('read_missing')
+            except EnhancedRPCError as e:
+                eq_('FileNotFoundError', e.parent)
+            else:
+                ok_(False, 'missing file sent')
+            # the connection is still usable after a file
+            eq_(content[:10], await client.call('read_file', 0, 10))
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()
+        os.remove(f.name)
+
+
+def test_file_region_fd_passing():
+    import mmap
+    import os
+    import tempfile
+
+    content = os.urandom(64 * 1024)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(content)
+    path = PATH + '.fd'
+    server = RPCServer()
+    server.register('read_file', lambda offset: FileRegion(f.name, offset))
+    unix_server = loop.run_until_complete(asyncio.start_unix_server(server.serve, path))
+
+    async def _test_call():
+        async with RPCClient(path=path, receive_fds=True) as client:
+            regions = await asyncio.gather(*[client.call('read_file', i) for i in range(3)])
+            for i, region in enumerate(regions):
+                eq_(i, region.offset)
+                eq_(len(content) - i, region.size())
+                with region, mmap.mmap(region.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    eq_(content, data[:])
+        # a client without fd passing still gets the content
+        async with RPCClient(path=path) as client:
+            eq_(content[5:], await client.call('read_file', 5))
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        unix_server.close()
+        os.remove(f.name)
+        os.remove(path)
+
+
+# Test bidirectional calls
+def test_server_calls_client_back():
+    peers = []
+
+    async def subscribe(peer, x):
+        peers.append(peer)
+        # answered by the client while this call is in progress
+        return await peer.call('double', x)
+
+    server = RPCServer()
+    server.register('subscribe', subscribe, peer=True)
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+    invalidated = []
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            client.register('double', lambda x: x * 2)
+            client.register('invalidate', invalidated.append)
+            eq_(42, await client.call('subscribe', 21))
+            eq_(1, len(peers))
+            # pushed outside of any request of the client
+            eq_(None, await peers[0].call('invalidate', 'key'))
+            try:
+                await peers[0].call('missing')
+            except EnhancedRPCError as e:
+                eq_('MethodNotFoundError', e.parent)
+            else:
+                ok_(False, 'client answered an unknown method')
+            eq_(8, await client.call('subscribe', 4))
+            eq_(peers[0], peers[1])
+        await asyncio.sleep(0.05)
+        ok_(peers[0].is_closed())
+
+    try:
+        loop.run_until_complete(_test_call())
+        eq_(['key'], invalidated)
+    finally:
+        tcp_server.close()
+
+
+# Test drain and hot swap
+def test_drain_migrates_clients():
+    old, new = RPCServer(), RPCServer()
+
+    async def where(delay):
+        await asyncio.sleep(delay)
+        return 'old'
+
+    old.register('where', where)
+    new.register('where', lambda delay: 'new')
+    old_listener = loop.run_until_complete(asyncio.start_server(old.serve, HOST, PORT + 2))
+    new_listener = loop.run_until_complete(asyncio.start_server(new.serve, HOST, PORT + 3))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            in_flight = asyncio.ensure_future(client.call('where', 0.3))
+            await asyncio.sleep(0.05)
+            drained = asyncio.ensure_future(old.drain(old_listener, migrate_to=(HOST, PORT + 3)))
+            await asyncio.sleep(0.05)
+            # the call in progress completes on the old server, new ones go to the new one
+            eq_('new', await client.call('where', 0))
+            eq_('old', await in_flight)
+            eq_(0, await drained)
+            eq_(0, old.get_metrics()['active_connections'])
+            eq_('new', await client.call('where', 0))
+        try:
+            await asyncio.open_connection(HOST, PORT + 2)
+        except OSError:
+            pass
+        else:
+            ok_(False, 'drained server accepted a connection')
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        new_listener.close()
+
+
+def test_swap_methods():
+    class Calculator:
+        def version(self):
+            return 1
+
+    class NewCalculator:
+        def version(self):
+            return 2
+
+    NewCalculator.__name__ = 'Calculator'
+
+    async def slow_version(delay):
+        await asyncio.sleep(delay)
+        return 1
+
+    server = RPCServer(interceptors=[lambda name, args, proceed: proceed(*args)])
+    server.register('version', slow_version)
+    server.register_class(Calculator)
+    staging = RPCServer()
+    staging.register('version', lambda delay: 2)
+    staging.register_class(NewCalculator)
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as first, RPCClient(HOST, PORT + 2) as second:
+            eq_(1, await first.call('Calculator.version'))
+            in_flight = asyncio.ensure_future(first.call('version', 0.2))
+            await asyncio.sleep(0.05)
+            server.swap_methods(staging)
+            eq_(2, await second.call('version', 0))
+            eq_(2, await second.call('Calculator.version'))
+            eq_(1, await in_flight)
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()
+
+
+# Test TLS
+def test_tls_session_resumption():
+    import os
+    import ssl
+
+    certfile = os.path.join(os.path.dirname(__file__), 'keycert.pem')
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(certfile)
+    client_context = ssl.create_default_context(cafile=certfile)
+    server = RPCServer()
+    server.register('echo', echo)
+    listener = loop.run_until_complete(server.start_server(HOST, PORT + 2, ssl=server_context))
+
+    async def _test_call():
+        first = RPCClient(HOST, PORT + 2, ssl=client_context)
+        eq_('message', await first.call('echo', 'message'))
+        eq_(1, first.get_metrics()['tls_handshakes'])
+        eq_(0, first.get_metrics()['tls_resumed'])
+        # a reconnect and a second client of the pool resume the session
+        first.close()
+        eq_('message', await first.call('echo', 'message'))
+        second = RPCClient(HOST, PORT + 2, ssl=client_context)
+        eq_('message', await second.call('echo', 'message'))
+        eq_(2, first.get_metrics()['tls_handshakes'])
+        eq_(1, first.get_metrics()['tls_resumed'])
+        eq_(1, second.get_metrics()['tls_resumed'])
+        ok_(first.get_metrics()['tls_handshake_ms_total'] > 0)
+        first.close()
+        second.close()
+
+        # the certificate does not match another name
+        client = RPCClient(HOST, PORT + 2, ssl=client_context, server_hostname='example.com',
+                           connect_attempts=1)
+        try:
+            await client.call('echo', 'message')
+        except ssl.SSLCertVerificationError:
+            pass
+        else:
+            ok_(False, 'certificate accepted for a wrong name')
+
+    try:
+        loop.run_until_complete(_test_call())
+        metrics = server.get_metrics()
+        eq_(3, metrics['tls_handshakes'])
+        eq_(2, metrics['tls_resumed'])
+    finally:
+        listener.close()
+
+
+# Test stubs
+def test_stub():
+    class Calculator:
+        def add(self, a, b=0):
+            return a + b
+
+        def total(self, *values):
+            return sum(values)
+
+        @staticmethod
+        def neg(a):
+            return -a
+
+    server = RPCServer()
+    server.register_class(Calculator)
+    tcp_server = loop.run_until_complete(asyncio.start_server(server.serve, HOST, PORT + 2))
+
+    async def _test_call():
+        async with RPCClient(HOST, PORT + 2) as client:
+            calculator = client.stub(Calculator)
+            eq_(3, await calculator.add(1, 2))
+            eq_(1, await calculator.add(1))
+            eq_(3, await calculator.add(b=2, a=1))
+            eq_(6, await calculator.total(1, 2, 3))
+            eq_(-1, await calculator.neg(1))
+            assert_raises(TypeError, calculator.add)
+            assert_raises(TypeError, calculator.add, 1, 2, 3)
+            assert_raises(TypeError, calculator.neg, 1, a=1)
+            # wrong calls never reach the server
+            eq_(5, server.get_metrics()['requests'])
+
+            # same frame as a plain call
+            client._msg_id = 0
+            plain, _ = client._create_request('Calculator.add', (1, 2))
+            client._msg_id = 0
+            encoded, _ = client._create_request('Calculator.add', (1, 2),
+                                                client._encode_method('Calculator.add'))
+            eq_(plain, encoded)
+
+        local = RPCClient(local=server)
+        eq_(3, await local.stub(Calculator).add(1, 2))
+
+    try:
+        loop.run_until_complete(_test_call())
+    finally:
+        tcp_server.close()